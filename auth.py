@@ -1,5 +1,9 @@
-from google_auth_oauthlib.flow import Flow
-from config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI
+import time
+import uuid
+import datetime
+from urllib.parse import urlencode, quote
+from config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, OAUTH_STATE_TTL, OAUTH_STATE_REUSE
+from database import oauth_states
 
 # --- CHANGED: "installed" -> "web" ---
 # This matches the new credentials you just created.
@@ -20,14 +24,52 @@ SCOPES = [
     "openid"
 ]
 
-def get_flow(state=None):
-    flow = Flow.from_client_config(
-        CLIENT_CONFIG, 
-        scopes=SCOPES, 
-        redirect_uri=REDIRECT_URI
-    )
-    
-    if state: 
-        flow.state = state
-        
-    return flow
+# --- PRE-BUILT LOGIN LINKS ---
+# Everything in the authorization URL except 'state' is fixed, so build it once.
+# (Same parameters google_auth_oauthlib's Flow produced, minus the PKCE challenge:
+# the verifier was never kept, and this is a confidential web client.)
+AUTH_URL_PREFIX = CLIENT_CONFIG["web"]["auth_uri"] + "?" + urlencode({
+    "response_type": "code",
+    "client_id": CLIENT_ID,
+    "redirect_uri": REDIRECT_URI,
+    "scope": " ".join(SCOPES),
+    "access_type": "offline",
+    "prompt": "consent",
+}) + "&state="
+
+def build_auth_url(state: str) -> str:
+    return AUTH_URL_PREFIX + quote(state)
+
+async def get_login_url(uid_str: str) -> str:
+    """
+    One state per user serves every login screen shown within
+    OAUTH_STATE_REUSE seconds, so rendering it costs a read, not a write.
+    The lookup goes to MongoDB, not RAM: the callback deletes a state on
+    use, on whichever instance Google sends the user to.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Note: We save uid as INT here, the callback converts it back to String.
+    live = await oauth_states.find_one({
+        "user_id": int(uid_str),
+        # Created within the reuse window = still valid for a while
+        "expires_at": {"$gt": now + datetime.timedelta(seconds=OAUTH_STATE_TTL - OAUTH_STATE_REUSE)},
+    }, {"state": 1})
+    if live:
+        return build_auth_url(live["state"])
+
+    state = uuid.uuid4().hex
+    await oauth_states.insert_one({
+        "state": state,
+        "user_id": int(uid_str),
+        "created_at": time.time(),
+        # TTL index removes the doc at this time
+        "expires_at": now + datetime.timedelta(seconds=OAUTH_STATE_TTL)
+    })
+    return build_auth_url(state)
+
+async def ensure_auth_indexes():
+    """TTL + lookup index on oauth_states (old states without expiry are dropped)."""
+    await oauth_states.create_index("expires_at", expireAfterSeconds=0)
+    await oauth_states.create_index("state")
+    await oauth_states.create_index("user_id")
+    await oauth_states.delete_many({"expires_at": {"$exists": False}})
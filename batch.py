@@ -0,0 +1,146 @@
+import re
+import json
+import uuid
+import asyncio
+import logging
+import aiohttp
+from config import BATCH_WINDOW, BATCH_MAX_SIZE, GMAIL_BATCH_URL
+from http_client import get_session
+from metrics import count_error
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = aiohttp.ClientTimeout(total=10)
+# Host the per-item paths are relative to ("/gmail/v1/users/me/...")
+API_ROOT = GMAIL_BATCH_URL.split("/batch/")[0]
+
+def build_batch_body(items: list, boundary: str) -> str:
+    """One application/http part per (access, path) GET; each carries its own token."""
+    parts = []
+    for i, (access, path) in enumerate(items):
+        parts.append(
+            f"--{boundary}\r\n"
+            f"Content-Type: application/http\r\n"
+            f"Content-ID: <item{i}>\r\n\r\n"
+            f"GET {path}\r\n"
+            f"Authorization: Bearer {access}\r\n\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts)
+
+def parse_batch_response(text: str, boundary: str) -> dict:
+    """
+    Splits a multipart/mixed batch response.
+    Returns {item index: (status, json or None)}.
+    """
+    results = {}
+    text = text.replace("\r\n", "\n")
+    for chunk in text.split(f"--{boundary}"):
+        chunk = chunk.strip("\n")
+        if not chunk or chunk.startswith("--"): continue
+
+        part_head, _, http = chunk.partition("\n\n")
+        m = re.search(r"Content-ID:\s*<response-item(\d+)>", part_head, re.I)
+        if not m: continue
+
+        status_line, _, rest = http.partition("\n")
+        try: status = int(status_line.split()[1])
+        except (IndexError, ValueError): continue
+
+        # Inner headers (if any), blank line, then the JSON body
+        body = rest[1:] if rest.startswith("\n") else rest.partition("\n\n")[2]
+        try: data = json.loads(body)
+        except ValueError: data = None
+        results[int(m.group(1))] = (status, data)
+    return results
+
+class GmailBatcher:
+    """
+    Collects Gmail GETs from all users for BATCH_WINDOW seconds (or until
+    BATCH_MAX_SIZE are waiting) and sends them as ONE multipart/mixed
+    request to the batch endpoint. Every caller gets its own (status, json)
+    back; an item failing inside the batch only fails that caller.
+    """
+    def __init__(self, window: float = BATCH_WINDOW, max_size: int = BATCH_MAX_SIZE, url: str = GMAIL_BATCH_URL):
+        self.window = window
+        self.max_size = max_size
+        self.url = url
+        self.queue = []
+        self.timer = None
+
+        # --- Stats ---
+        self.batches = 0
+        self.items = 0
+        self.item_errors = 0
+        self.batch_errors = 0
+
+    async def get(self, access: str, path: str):
+        """Queues one GET (path relative to the API host). Returns (status, json)."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.queue.append((access, path, fut))
+
+        if len(self.queue) >= self.max_size:
+            self._dispatch()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._dispatch)
+        return await fut
+
+    def _dispatch(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.queue = self.queue, []
+        if batch:
+            asyncio.create_task(self._send(batch))
+
+    async def _send(self, batch: list):
+        session = get_session()
+
+        # A batch of one is just a normal request
+        if len(batch) == 1:
+            access, path, fut = batch[0]
+            result = (None, None)
+            try:
+                headers = {"Authorization": f"Bearer {access}"}
+                async with session.get(f"{API_ROOT}{path}", headers=headers, timeout=TIMEOUT) as r:
+                    result = (r.status, await r.json())
+            except Exception as e: count_error("gmail_batch", e)
+            self.items += 1
+            if not fut.done(): fut.set_result(result)
+            return
+
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body = build_batch_body([(a, p) for a, p, _ in batch], boundary)
+        results = {}
+        try:
+            headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+            async with session.post(self.url, data=body.encode(), headers=headers, timeout=TIMEOUT) as r:
+                text = await r.text()
+                m = re.search(r'boundary="?([^";]+)"?', r.headers.get("Content-Type", ""))
+                if r.status == 200 and m:
+                    results = parse_batch_response(text, m.group(1))
+                else:
+                    self.batch_errors += 1
+        except Exception as e:
+            self.batch_errors += 1
+            count_error("gmail_batch", e)
+            logger.debug(f"Gmail batch failed: {e}")
+
+        self.batches += 1
+        self.items += len(batch)
+        for i, (_, _, fut) in enumerate(batch):
+            status, data = results.get(i, (None, None))
+            if status != 200: self.item_errors += 1
+            if not fut.done(): fut.set_result((status, data))
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "item_errors": self.item_errors,
+            "batch_errors": self.batch_errors,
+            "queued": len(self.queue),
+        }
+
+BATCHER = GmailBatcher()
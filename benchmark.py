@@ -0,0 +1,333 @@
+"""
+Offline benchmark: runs the real watcher (services.background_watcher) and
+Telegram handlers against local stand-ins, no network needed:
+- fake Gmail API + fake Bot API (fakes.py stack, separate process)
+- in-memory MongoDB (fakes.MemoryMongoClient via database.set_client)
+
+    python benchmark.py                          # 100, 1000 and 10000 users
+    python benchmark.py --users 1000 --duration 60 --latency 0.08 --error-rate 0.02
+
+Each scale runs in a fresh process and reports:
+- polls/sec          process_user runs finished per second
+- CPU per user       bot process CPU time per user per second (ms)
+- memory per user    RSS growth after seeding, per user (KB)
+- time-to-OTP        Gmail internalDate -> Telegram edit acked (p50/p95/p99),
+                     for all users and for the hot tier only
+- handler latency    "↻ Refresh" message fed through the dispatcher
+The in-memory Mongo lives in the bot process, so its CPU and RAM are part
+of the numbers (a real mongod would take them out of the process).
+Any other knob (POLL_CONCURRENCY, OFFLOAD_MODE, ...) is read from the
+environment as usual.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import resource
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:BENCHMARK"
+
+# --- MEASUREMENT HELPERS ---
+def rss_kb() -> int:
+    """Current RSS (Linux), peak RSS elsewhere."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1])
+    except OSError: pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def cpu_seconds() -> float:
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def percentiles(values: list) -> dict:
+    if not values: return {"n": 0, "p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 3)
+    return {"n": len(values), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def log(msg: str):
+    # stdout carries the RESULT line
+    print(msg, file=sys.stderr, flush=True)
+
+def uid_of(i: int) -> str:
+    return str(100000000 + i)
+
+# --- ONE SCALE (child process) ---
+async def start_stack(args, port: int):
+    cmd = [
+        sys.executable, os.path.join(HERE, "fakes.py"), "stack", str(port),
+        "--users", str(args.child), "--mailbox", str(args.mailbox), "--padding", str(args.padding),
+        "--latency", str(args.latency), "--error-rate", str(args.error_rate), "--bot-latency", str(args.bot_latency),
+    ]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+    line = await asyncio.wait_for(proc.stdout.readline(), timeout=120)
+    if b"READY" not in line:
+        proc.kill()
+        raise RuntimeError("fake stack did not start")
+    return proc
+
+async def seed_users(users, count: int, mailbox: int, hot: float):
+    """Logged-in users whose checkpoint is the mailbox's current historyId."""
+    now = time.time()
+    for i in range(count):
+        await users.insert_one({
+            "uid": uid_of(i),
+            "email": f"user{i}@example.com",
+            "is_active": True,
+            "access": f"tok-{i}",
+            "refresh": f"refresh-{i}",
+            "access_expires_at": now + 86400,
+            "main_msg_id": 1,
+            # FakeGmail starts every mailbox at 1000 and bumps it per mail
+            "history_id": str(1000 + mailbox),
+            "last_gen_timestamp": now if i < count * hot else 0,
+            "updated_at": now,
+        })
+
+def refresh_update(update_id: int, uid: str, message_id: int) -> dict:
+    user = {"id": int(uid), "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(uid), "type": "private"},
+            "from": user,
+            "text": "↻ Refresh",
+        },
+    }
+
+async def inject_otps(session, base: str, args, stop: asyncio.Event, sent: dict):
+    """New OTP mails at --otp-rate per second, to random users (hot ones first in line)."""
+    hot_count = int(args.child * args.hot)
+    while not stop.is_set():
+        i = random.randrange(hot_count) if hot_count and random.random() < args.hot_share else random.randrange(args.child)
+        body = {"token": f"tok-{i}", "code": f"{random.randrange(10**6):06d}", "padding": args.padding}
+        try:
+            async with session.post(f"{base}/_admin/gmail/deliver", json=body) as r:
+                if r.status == 200: sent["mails"] += 1
+        except Exception: sent["failed"] += 1
+        await asyncio.sleep(1 / args.otp_rate)
+
+async def feed_refreshes(dp, bot, args, stop: asyncio.Event, latencies: list):
+    """'↻ Refresh' presses at --refresh-rate per second, through the real handlers."""
+    from aiogram.types import Update
+    update_id = 0
+    while not stop.is_set():
+        update_id += 1
+        uid = uid_of(random.randrange(args.child))
+        update = Update.model_validate(refresh_update(update_id, uid, 10**6 + update_id), context={"bot": bot})
+
+        async def handle(update=update):
+            started = time.monotonic()
+            try:
+                await dp.feed_update(bot, update)
+                latencies.append(time.monotonic() - started)
+            except Exception: pass
+        asyncio.create_task(handle())
+        await asyncio.sleep(1 / args.refresh_rate)
+
+async def run_child(args, port: int):
+    import aiohttp
+    import logging
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import database
+    from fakes import MemoryMongoClient
+    # Before anything imports the collections (see database.set_client)
+    database.set_client(MemoryMongoClient())
+    import services
+    import tracing
+    from database import users, WRITE_BEHIND
+    from handlers import router
+    from partitions import LEASES
+    from executor import EXECUTOR
+    from scheduler import SCHEDULER
+    from outbox import OUTBOX
+    from http_client import start_http, close_http
+    logging.basicConfig(level=logging.WARNING)
+
+    base = f"http://127.0.0.1:{port}"
+    stack = await start_stack(args, port)
+    hot_uids = {uid_of(i) for i in range(int(args.child * args.hot))}
+    # (uid, mid) -> seconds to delivery; a manual Refresh can deliver a mail again, keep the first
+    delivered = {}
+    tracing.SINKS.append(lambda record: delivered.setdefault((record["uid"], record["mid"]), record["stages"].get("delivered")))
+
+    try:
+        rss_start = rss_kb()
+        await seed_users(users, args.child, args.mailbox, args.hot)
+        log(f"   seeded {args.child} users, warming up...")
+        rss_seeded = rss_kb()
+
+        await start_http()
+        bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.include_router(router)
+
+        # Everybody already has a dashboard message -> no "fresh start" sends
+        for i in range(args.child):
+            services.ACTIVE_SESSION_CACHE[uid_of(i)] = True
+
+        await LEASES.start()
+        await LEASES.announce_ready()
+        tasks = [
+            asyncio.create_task(WRITE_BEHIND.run()),
+            asyncio.create_task(services.background_watcher(bot)),
+        ]
+
+        # --- Warm-up: every user scheduled, first polls out of the way ---
+        deadline = time.monotonic() + 120
+        while len(SCHEDULER.users) < args.child and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(args.warmup)
+
+        # --- Measured window ---
+        log(f"   {len(SCHEDULER.users)} users scheduled, measuring...")
+        stop = asyncio.Event()
+        sent = {"mails": 0, "failed": 0}
+        handler_latency = []
+        delivered.clear()
+        polls_before, cpu_before, started = EXECUTOR.completed, cpu_seconds(), time.monotonic()
+        async with aiohttp.ClientSession() as admin:
+            load = [
+                asyncio.create_task(inject_otps(admin, base, args, stop, sent)),
+                asyncio.create_task(feed_refreshes(dp, bot, args, stop, handler_latency)),
+            ]
+            await asyncio.sleep(args.duration)
+            stop.set()
+            elapsed = time.monotonic() - started
+            polls = EXECUTOR.completed - polls_before
+            cpu = cpu_seconds() - cpu_before
+            rss_end = rss_kb()
+            # Let in-flight mails finish (not counted in polls/CPU)
+            await asyncio.sleep(args.settle)
+            await asyncio.gather(*load, return_exceptions=True)
+
+            async with admin.get(f"{base}/_admin/gmail/stats") as r: gmail_stats = await r.json()
+            async with admin.get(f"{base}/_admin/telegram/stats") as r: telegram_stats = await r.json()
+
+        log("   done, shutting down")
+        for task in tasks: task.cancel()
+        await EXECUTOR.stop()
+        await LEASES.stop()
+        await bot.session.close()
+
+        all_times = [s for s in delivered.values() if s is not None]
+        hot_times = [s for (uid, _), s in delivered.items() if s is not None and uid in hot_uids]
+        return {
+            "users": args.child,
+            "duration": round(elapsed, 1),
+            "polls_per_sec": round(polls / elapsed, 1),
+            "cpu_ms_per_user_sec": round(cpu / elapsed / args.child * 1000, 4),
+            "cpu_util": round(cpu / elapsed, 3),
+            "rss_kb_per_user": round((rss_end - rss_seeded) / args.child, 2),
+            "rss_mb": round(rss_end / 1024, 1),
+            "rss_seed_mb": round((rss_seeded - rss_start) / 1024, 1),
+            "mails_sent": sent["mails"],
+            "time_to_otp": percentiles(all_times),
+            "time_to_otp_hot": percentiles(hot_times),
+            "handler_latency": percentiles(handler_latency),
+            "executor": EXECUTOR.stats(),
+            "outbox": OUTBOX.stats(),
+            "gmail": gmail_stats,
+            "telegram": telegram_stats,
+        }
+    finally:
+        await close_http()
+        stack.kill()
+        await stack.wait()
+
+def child_main(args):
+    port = free_port()
+    # Before any bot module is imported: config.py reads these once
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        # Never connected to: database.set_client() swaps in the in-memory fake
+        "MONGO_URI": "mongodb://127.0.0.1:1",
+        "GMAIL_API_ROOT": f"http://127.0.0.1:{port}",
+        "GMAIL_BATCH_URL": f"http://127.0.0.1:{port}/batch/gmail/v1",
+        "PUSH_TOPIC": "",
+        "OTP_TRACE_LOG": "",
+    })
+    sys.path.insert(0, HERE)
+    result = asyncio.run(run_child(args, port))
+    print("RESULT " + json.dumps(result), flush=True)
+
+# --- DRIVER ---
+def fmt(p: dict) -> str:
+    if not p["n"]: return "-"
+    return f"{p['p50']}/{p['p95']}/{p['p99']}s"
+
+def print_table(results: list):
+    head = ("users", "polls/s", "CPU ms/user/s", "RSS KB/user", "OTP p50/p95/p99", "hot OTP p50/p95/p99", "Refresh p50/p95/p99", "edits")
+    rows = [(
+        r["users"], r["polls_per_sec"], r["cpu_ms_per_user_sec"], r["rss_kb_per_user"],
+        f"{fmt(r['time_to_otp'])} (n={r['time_to_otp']['n']})", fmt(r["time_to_otp_hot"]),
+        fmt(r["handler_latency"]), r["telegram"]["edits"],
+    ) for r in results]
+    widths = [max(len(str(x)) for x in col) for col in zip(head, *rows)]
+    for row in (head, *rows):
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the watcher and handlers")
+    parser.add_argument("--users", default="100,1000,10000", help="comma-separated scales")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per scale")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds after all users are scheduled")
+    parser.add_argument("--settle", type=float, default=5, help="seconds to let the last OTPs land")
+    parser.add_argument("--mailbox", type=int, default=20, help="old mails per mailbox")
+    parser.add_argument("--padding", type=int, default=0, help="extra body bytes per mail")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Gmail latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Gmail requests answering 500")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="fake Bot API latency (s)")
+    parser.add_argument("--hot", type=float, default=0.1, help="share of users in the hot tier")
+    parser.add_argument("--hot-share", type=float, default=0.8, help="share of OTP mails sent to hot users")
+    parser.add_argument("--otp-rate", type=float, default=5, help="OTP mails per second")
+    parser.add_argument("--refresh-rate", type=float, default=1, help="'↻ Refresh' presses per second")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    if args.child:
+        return child_main(args)
+
+    results = []
+    for n in [int(x) for x in args.users.split(",") if x.strip()]:
+        print(f"🏁 {n} users: {args.duration:.0f}s measured...", file=sys.stderr, flush=True)
+        cmd = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--child", str(n)]
+        try:
+            # Seeding + warm-up can take a while at 10k users
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, timeout=args.warmup + args.duration + args.settle + 600)
+        except subprocess.TimeoutExpired:
+            print(f"❌ {n} users: timed out", file=sys.stderr)
+            continue
+        line = next((l for l in proc.stdout.splitlines() if l.startswith("RESULT ")), None)
+        if proc.returncode or not line:
+            print(f"❌ {n} users: run failed (exit {proc.returncode})", file=sys.stderr)
+            continue
+        results.append(json.loads(line[len("RESULT "):]))
+
+    if args.json: print(json.dumps(results, indent=2))
+    else: print_table(results)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 import sys
 import uuid
+import hashlib
 
 # --- ENV VARIABLES ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -25,14 +26,146 @@ else:
 # Railway assigns a random port here. Default to 8080.
 PORT = int(os.getenv("PORT", 8080))
 
+# --- TELEGRAM UPDATES ---
+# "polling" (local runs) or "webhook": Telegram POSTs updates to this app,
+# so any instance behind the load balancer can take them
+TG_UPDATE_MODE = os.getenv("TG_UPDATE_MODE", "polling")
+TG_WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/telegram/webhook")
+TG_WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL", f"https://{RAILWAY_DOMAIN}{TG_WEBHOOK_PATH}")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; other callers get 401.
+# Defaults to a value derived from the bot token (same on every instance).
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET") or hashlib.sha256((os.getenv("BOT_TOKEN") or "").encode()).hexdigest()[:32]
+
+# --- OAUTH LOGIN STATES (seconds) ---
+# A login link stays valid for TTL; the same link is reused for REUSE
+OAUTH_STATE_TTL = int(os.getenv("OAUTH_STATE_TTL", 1800))
+OAUTH_STATE_REUSE = int(os.getenv("OAUTH_STATE_REUSE", 600))
+
+# --- SHARED HTTP CLIENT ---
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 200))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", 100))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))
+
+# --- ACCESS TOKENS (seconds) ---
+# Refresh this long before expiry, plus a per-user offset of up to JITTER
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+TOKEN_REFRESH_JITTER = float(os.getenv("TOKEN_REFRESH_JITTER", 120))
+
+# --- GMAIL BATCH REQUESTS ---
+# Message fetches from all users are grouped for BATCH_WINDOW seconds
+# into one multipart/mixed request (Gmail allows up to 100 per batch)
+BATCH_ENABLED = os.getenv("BATCH_ENABLED", "1") == "1"
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", 0.02))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 50))
+GMAIL_API_ROOT = os.getenv("GMAIL_API_ROOT", "https://gmail.googleapis.com").rstrip("/")
+GMAIL_BATCH_URL = os.getenv("GMAIL_BATCH_URL", f"{GMAIL_API_ROOT}/batch/gmail/v1")
+
+# Try Subject + snippet (format=metadata) before downloading the raw message
+METADATA_FIRST = os.getenv("METADATA_FIRST", "1") == "1"
+
+# Raw messages: decode at most this many bytes, keep at most this many text chars
+MIME_BYTE_BUDGET = int(os.getenv("MIME_BYTE_BUDGET", 256 * 1024))
+MIME_TEXT_LIMIT = int(os.getenv("MIME_TEXT_LIMIT", 20000))
+
+# --- CPU OFFLOAD (MIME parsing + OTP extraction of raw messages) ---
+# "off" (parse on the event loop), "process" (process pool, uses more
+# cores) or "thread" (only helps where the work releases the GIL)
+OFFLOAD_MODE = os.getenv("OFFLOAD_MODE", "off")
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", os.cpu_count() or 2))
+# Raw payloads smaller than this (chars) are parsed inline: cheaper than the hop
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", 16 * 1024))
+# Max messages queued or parsing in the pool; further polls wait (backpressure)
+OFFLOAD_MAX_PENDING = int(os.getenv("OFFLOAD_MAX_PENDING", 64))
+
+# --- GMAIL PUSH (users.watch -> Pub/Sub -> /gmail/push) ---
+# Full Pub/Sub topic name, e.g. "projects/my-project/topics/gmail-push".
+# Leave empty to keep pure polling.
+PUSH_TOPIC = os.getenv("PUSH_TOPIC", "")
+# Shared secret appended to the push subscription URL as ?token=...
+# (required when PUSH_TOPIC is set)
+PUSH_TOKEN = os.getenv("PUSH_TOKEN", "")
+# Watched users are still polled this often (seconds) as a safety net
+PUSH_SAFETY_POLL = float(os.getenv("PUSH_SAFETY_POLL", 60))
+# If no push has arrived for this long, fall back to normal polling
+PUSH_STALE_AFTER = float(os.getenv("PUSH_STALE_AFTER", 600))
+# Renew a watch when it has less than this many seconds left (Gmail gives 7 days)
+WATCH_RENEW_MARGIN = float(os.getenv("WATCH_RENEW_MARGIN", 86400))
+
+# --- POLL SCHEDULER (seconds) ---
+# "Hot" users (alias generated / OTP received / Refresh pressed recently)
+# are polled fast, everyone else backs off.
+POLL_HOT_INTERVAL = float(os.getenv("POLL_HOT_INTERVAL", 0.5))
+POLL_WARM_INTERVAL = float(os.getenv("POLL_WARM_INTERVAL", 5))
+POLL_IDLE_INTERVAL = float(os.getenv("POLL_IDLE_INTERVAL", 30))
+POLL_HOT_WINDOW = float(os.getenv("POLL_HOT_WINDOW", 300))
+POLL_WARM_WINDOW = float(os.getenv("POLL_WARM_WINDOW", 3600))
+# +/- fraction of the interval added as random jitter to every poll
+POLL_JITTER = float(os.getenv("POLL_JITTER", 0.2))
+
+# --- POLL EXECUTOR ---
+# Max mailboxes polled at the same time, and hard deadline (seconds) per poll
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", 50))
+POLL_DEADLINE = float(os.getenv("POLL_DEADLINE", 15))
+
+# --- USER CACHE ---
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+
+# --- SEEN MESSAGE INDEX ---
+# Message ids remembered in RAM per user (older ones are checked in MongoDB)
+SEEN_PER_USER = int(os.getenv("SEEN_PER_USER", 200))
+# Seconds MongoDB keeps a processed id (TTL index); by then Gmail won't list it again
+SEEN_TTL = int(os.getenv("SEEN_TTL", 30 * 86400))
+
+# --- WRITE-BEHIND (seconds between batched user writes) ---
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 1))
+
+# --- ACTIVE USER REGISTRY (seconds) ---
+# Only used when MongoDB has no change streams (standalone server)
+REGISTRY_POLL_INTERVAL = float(os.getenv("REGISTRY_POLL_INTERVAL", 1))
+REGISTRY_DIFF_INTERVAL = float(os.getenv("REGISTRY_DIFF_INTERVAL", 30))
+
+# --- TELEGRAM OUTBOX (messages per second) ---
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", 30))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+
+# --- MULTI-INSTANCE LEASES (seconds) ---
+# Users are split into PARTITIONS by uid hash; each running instance leases
+# a share of them and only polls its own. A dead instance's leases expire
+# after LEASE_TTL and are picked up by the others.
+PARTITIONS = int(os.getenv("PARTITIONS", 64))
+LEASE_TTL = float(os.getenv("LEASE_TTL", 15))
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", 1))
+# Max seconds an old instance spends draining polls/edits before it lets go
+HANDOVER_TIMEOUT = float(os.getenv("HANDOVER_TIMEOUT", 20))
+
+# --- TIME-TO-OTP TRACES ---
+# File to append one JSON line per delivered OTP (stage timings); empty = off
+OTP_TRACE_LOG = os.getenv("OTP_TRACE_LOG", "")
+
 # --- DEPLOYMENT CONFLICT FIX ---
-# Generates a unique ID every time the bot restarts to kill old versions
+# Generates a unique ID every time the bot restarts (lease owner id)
 INSTANCE_ID = uuid.uuid4().hex 
+# Instances of an older deployment hand over to a newer one once it is ready.
+# Every replica of one deploy must share this id: set DEPLOYMENT_ID, or let
+# Railway's deployment id / git commit stand in. Without any of them all
+# processes count as one deployment and split the partitions (no handover).
+DEPLOYMENT_ID = (os.getenv("DEPLOYMENT_ID") or os.getenv("RAILWAY_DEPLOYMENT_ID")
+                 or os.getenv("RAILWAY_GIT_COMMIT_SHA") or "default")
 
 # --- SAFETY CHECK ---
 if not MONGO_URI or not BOT_TOKEN:
     print("❌ CRITICAL ERROR: Missing BOT_TOKEN or MONGO_URI.")
     sys.exit(1)
 
+# Pushes trigger mailbox checks: never accept them unauthenticated
+if PUSH_TOPIC and not PUSH_TOKEN:
+    print("❌ CRITICAL ERROR: PUSH_TOPIC is set but PUSH_TOKEN is missing.")
+    sys.exit(1)
+
 if not CLIENT_ID or not CLIENT_SECRET:
     print("⚠️ WARNING: CLIENT_ID or CLIENT_SECRET missing. Google Login will fail.")
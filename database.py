@@ -1,20 +1,110 @@
+import time
+import asyncio
+import datetime
+import logging
+from collections import OrderedDict
+from pymongo import UpdateOne, ReturnDocument
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGO_URI
+from metrics import count_error
+from config import MONGO_URI, SEEN_PER_USER, SEEN_TTL, WRITE_BEHIND_INTERVAL, USER_CACHE_SIZE, USER_CACHE_TTL
+
+logger = logging.getLogger(__name__)
 
 # Initialize Database Connection
-client = AsyncIOMotorClient(MONGO_URI)
-db = client['gmail_otp_bot']
+client = db = None
+
+def set_client(new_client):
+    """
+    Points the database and every collection at 'new_client' (benchmark.py
+    swaps in fakes.MemoryMongoClient). Modules that did 'from database import
+    users' keep the old objects, so call this before importing them.
+    """
+    global client, db, users, seen_msgs, oauth_states, server_lock, leases, workers, deployments
+    if client is not None: client.close()
+    client = new_client
+    db = client['gmail_otp_bot']
 
-# --- Collections ---
-users = db['users']
-seen_msgs = db['seen_messages']
-oauth_states = db['oauth_states']
-server_lock = db['server_lock']
+    # --- Collections ---
+    users = db['users']
+    seen_msgs = db['seen_messages']
+    oauth_states = db['oauth_states']
+    server_lock = db['server_lock']
+    leases = db['partition_leases']
+    workers = db['workers']
+    deployments = db['deployments']
+
+set_client(AsyncIOMotorClient(MONGO_URI))
 
 # --- RAM CACHE (Enabled for Speed) ---
 # We use this to make button clicks instant, while services.py 
 # bypasses it for critical login detection.
-USER_CACHE = {}
+class UserCache:
+    """
+    Bounded LRU cache of user docs with a per-entry TTL.
+    Keeps memory flat as the user base grows; expired entries are simply
+    re-read from MongoDB on the next get_user().
+    """
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+        # --- Stats ---
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def peek(self, uid: str):
+        """Returns a live entry without touching stats or LRU order."""
+        entry = self.entries.get(uid)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def get(self, uid: str):
+        entry = self.entries.get(uid)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[uid]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(uid)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, uid: str, doc: dict):
+        self.entries[uid] = (time.monotonic() + self.ttl, doc)
+        self.entries.move_to_end(uid)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, uid: str):
+        self.entries.pop(uid, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+USER_CACHE = UserCache()
+
+# The token blob is never needed outside the OAuth callback
+CACHE_PROJECTION = {"google_token": 0}
 
 async def get_user(uid: str):
     """
@@ -22,15 +112,17 @@ async def get_user(uid: str):
     Priority: RAM (Fast) -> Database (Slow)
     """
     # 1. Check RAM first (Instant response)
-    if uid in USER_CACHE:
-        return USER_CACHE[uid]
+    user = USER_CACHE.get(uid)
+    if user is not None:
+        return user
     
-    # 2. If not in RAM, fetch from Database
-    user = await users.find_one({"uid": uid})
+    # 2. If not in RAM, fetch from Database (plus writes not flushed yet)
+    user = await users.find_one({"uid": uid}, CACHE_PROJECTION)
     
     # 3. Save to RAM for next time
     if user:
-        USER_CACHE[uid] = user
+        user = WRITE_BEHIND.overlay(uid, user)
+        USER_CACHE.put(uid, user)
         
     return user
 
@@ -38,17 +130,39 @@ async def update_user(uid: str, data: dict):
     """
     Updates both Database and RAM immediately.
     """
-    # 1. Update Database (Persistent Storage)
-    await users.update_one({"uid": uid}, {"$set": data}, upsert=True)
-    
-    # 2. Update RAM (So the UI updates instantly without re-fetching)
-    if uid in USER_CACHE:
-        USER_CACHE[uid].update(data)
+    # A direct write wins over anything still buffered for the same fields
+    WRITE_BEHIND.discard_fields(uid, data)
+
+    # 'updated_at' lets the registry follow changes without change streams
+    update = {"$set": {**data, "updated_at": time.time()}}
+    cached = USER_CACHE.peek(uid)
+
+    if cached is not None:
+        # 1. Update Database (Persistent Storage)
+        await users.update_one({"uid": uid}, update, upsert=True)
+        # 2. Update RAM (So the UI updates instantly without re-fetching)
+        cached.update(data)
     else:
-        # If the user wasn't in cache, fetch the full object to be safe
-        user = await users.find_one({"uid": uid})
+        # Not cached: write and read back the full doc in ONE round trip
+        user = await users.find_one_and_update(
+            {"uid": uid}, update, upsert=True,
+            projection=CACHE_PROJECTION, return_document=ReturnDocument.AFTER
+        )
         if user:
-            USER_CACHE[uid] = user
+            USER_CACHE.put(uid, WRITE_BEHIND.overlay(uid, user))
+
+async def ensure_indexes():
+    """
+    Lookup indexes for the hot queries (uid everywhere, 'updated_at' for the
+    registry poll, 'key' for SeenIndex misses) + TTL on seen message ids.
+    """
+    await users.create_index("uid")
+    await users.create_index("updated_at")
+    await seen_msgs.create_index("at", expireAfterSeconds=SEEN_TTL)
+    # Ids stored before 'at' was a date never expire by TTL
+    await seen_msgs.delete_many({"at": {"$lt": time.time() - SEEN_TTL}})
+    # Last: fails (and is logged) if old racing upserts left duplicate keys
+    await seen_msgs.create_index("key", unique=True)
 
 async def delete_user_data(uid: str):
     """
@@ -58,5 +172,200 @@ async def delete_user_data(uid: str):
     await users.delete_one({"uid": uid})
     
     # 2. Delete from RAM
-    if uid in USER_CACHE:
-        del USER_CACHE[uid]
+    USER_CACHE.invalidate(uid)
+    SEEN_INDEX.forget(uid)
+    WRITE_BEHIND.drop(uid)
+    # Imported here: push.py builds on this module
+    from push import forget_uid
+    forget_uid(uid)
+
+# --- SEEN MESSAGE INDEX ---
+class SeenIndex:
+    """
+    Remembers which Gmail message ids were already processed.
+    RAM first (a bounded set per user), MongoDB only for RAM misses:
+    one batched $in lookup per poll and one bulk_write for new keys.
+    """
+    def __init__(self, per_user: int = SEEN_PER_USER):
+        self.per_user = per_user
+        self.keys = {}
+
+        # --- Stats ---
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, uid: str, mids):
+        known = self.keys.setdefault(uid, OrderedDict())
+        for mid in mids:
+            known[mid] = None
+            known.move_to_end(mid)
+        # Oldest ids fall out first; Mongo still has them
+        while len(known) > self.per_user:
+            known.popitem(last=False)
+
+    async def filter_unseen(self, uid: str, mids: list) -> list:
+        """Returns the ids in 'mids' that were never processed, in order."""
+        known = self.keys.get(uid, {})
+        unknown = [mid for mid in mids if mid not in known]
+        self.hits += len(mids) - len(unknown)
+        if not unknown: return []
+
+        self.misses += len(unknown)
+        cursor = seen_msgs.find({"key": {"$in": [f"{uid}:{mid}" for mid in unknown]}}, {"key": 1})
+        found = {doc["key"].split(":", 1)[1] async for doc in cursor}
+        if found: self._remember(uid, found)
+
+        return [mid for mid in unknown if mid not in found]
+
+    async def mark_seen(self, uid: str, mids: list):
+        if not mids: return
+        self._remember(uid, mids)
+        # A date, so the TTL index on 'at' can expire it
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await seen_msgs.bulk_write(
+            [UpdateOne({"key": f"{uid}:{mid}"}, {"$set": {"at": now}}, upsert=True) for mid in mids],
+            ordered=False
+        )
+
+    def forget(self, uid: str):
+        self.keys.pop(uid, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self.keys), "hits": self.hits, "misses": self.misses}
+
+SEEN_INDEX = SeenIndex()
+
+# --- WRITE-BEHIND BUFFER (users collection) ---
+# Fields that only matter while the process runs; never written to MongoDB
+EPHEMERAL_FIELDS = {"last_check"}
+
+class WriteBehind:
+    """
+    Collects the watcher's $set/$inc updates per uid, applies them to RAM at
+    once and writes them to MongoDB in one bulk_write every
+    WRITE_BEHIND_INTERVAL seconds (and on shutdown).
+    """
+    def __init__(self, interval: float = WRITE_BEHIND_INTERVAL):
+        self.interval = interval
+        self.pending = {}
+        self.ephemeral = {}
+        # Batches taken out of 'pending' and not written yet: generation -> batch
+        self.inflight = {}
+        self.generation = 0
+        # uid -> {field: generation} of fields a direct write (update_user)
+        # replaced while a batch was in flight: if that batch fails, they
+        # must not come back on top of the newer value
+        self.discarded = {}
+
+        # --- Stats ---
+        self.buffered = 0
+        self.flushed = 0
+        self.flushes = 0
+
+    def update(self, uid: str, set_data: dict = None, inc_data: dict = None):
+        set_data = dict(set_data or {})
+        inc_data = inc_data or {}
+
+        # 1. RAM first, so the UI sees the change immediately
+        cached = USER_CACHE.peek(uid)
+        if cached is not None:
+            cached.update(set_data)
+            for k, v in inc_data.items():
+                cached[k] = (cached.get(k) or 0) + v
+
+        # 2. Ephemeral fields stop here
+        for k in EPHEMERAL_FIELDS & set_data.keys():
+            self.ephemeral.setdefault(uid, {})[k] = set_data.pop(k)
+        if not set_data and not inc_data: return
+
+        # 3. Merge into the pending op for this uid
+        op = self.pending.setdefault(uid, {"$set": {}, "$inc": {}})
+        op["$set"].update(set_data)
+        for k, v in inc_data.items():
+            op["$inc"][k] = op["$inc"].get(k, 0) + v
+        self.buffered += 1
+
+    def overlay(self, uid: str, doc: dict) -> dict:
+        """Re-applies not-yet-flushed changes on top of a doc read from MongoDB."""
+        doc.update(self.ephemeral.get(uid, {}))
+        # In-flight batches may already be in the doc: $set is safe to
+        # apply twice, $inc is not (off by one until the flush finishes)
+        for batch in self.inflight.values():
+            if uid in batch: doc.update(batch[uid]["$set"])
+        op = self.pending.get(uid)
+        if op:
+            doc.update(op["$set"])
+            for k, v in op["$inc"].items():
+                doc[k] = (doc.get(k) or 0) + v
+        return doc
+
+    def discard_fields(self, uid: str, data: dict):
+        if self.inflight:
+            marks = self.discarded.setdefault(uid, {})
+            for k in data: marks[k] = self.generation
+        op = self.pending.get(uid)
+        if not op: return
+        for k in data:
+            op["$set"].pop(k, None)
+            op["$inc"].pop(k, None)
+
+    def drop(self, uid: str):
+        self.pending.pop(uid, None)
+        self.ephemeral.pop(uid, None)
+
+    async def flush(self):
+        if not self.pending: return
+        batch, self.pending = self.pending, {}
+        self.generation += 1
+        taken = self.generation
+        self.inflight[taken] = batch
+
+        now = time.time()
+        ops = []
+        for uid, op in batch.items():
+            update = {"$set": {**op["$set"], "updated_at": now}}
+            if op["$inc"]: update["$inc"] = op["$inc"]
+            # No upsert: a user who logged out meanwhile must stay deleted
+            ops.append(UpdateOne({"uid": uid}, update))
+
+        try:
+            await users.bulk_write(ops, ordered=False)
+            self.flushed += len(ops)
+            self.flushes += 1
+        except Exception as e:
+            count_error("write_behind_flush", e)
+            logger.error(f"Write-behind flush failed: {e}")
+            # Put the batch back; anything buffered since is newer and wins,
+            # and fields a direct write replaced meanwhile stay dropped
+            for uid, op in batch.items():
+                for k, gen in self.discarded.get(uid, {}).items():
+                    if gen >= taken:
+                        op["$set"].pop(k, None)
+                        op["$inc"].pop(k, None)
+                if not op["$set"] and not op["$inc"]: continue
+                newer = self.pending.setdefault(uid, {"$set": {}, "$inc": {}})
+                newer["$set"] = {**op["$set"], **newer["$set"]}
+                for k, v in op["$inc"].items():
+                    newer["$inc"][k] = newer["$inc"].get(k, 0) + v
+        finally:
+            del self.inflight[taken]
+            if not self.inflight: self.discarded.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "buffered": self.buffered,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+        }
+
+WRITE_BEHIND = WriteBehind()
+
+def buffer_update(uid: str, set_data: dict = None, inc_data: dict = None):
+    """Non-blocking user update for hot paths (see WriteBehind)."""
+    WRITE_BEHIND.update(uid, set_data, inc_data)
@@ -0,0 +1,117 @@
+import time
+import asyncio
+import logging
+from config import POLL_CONCURRENCY, POLL_DEADLINE
+from metrics import count_error, POLL_DURATION, POLL_QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+class PollExecutor:
+    """
+    Runs polls with a fixed number of workers.
+    Every user is an independent job: a slow or failing mailbox only
+    occupies one worker until its deadline, it never holds up the others.
+    """
+    def __init__(self, concurrency: int = POLL_CONCURRENCY, deadline: float = POLL_DEADLINE):
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.queue = asyncio.Queue()
+        # uids queued or running (a user is never polled twice at once)
+        self.pending = set()
+        # uids submitted with rerun=True while pending: polled once more after
+        self.again = set()
+        self.workers = []
+        self.run = None
+        self.on_done = None
+
+        # --- Stats ---
+        self.completed = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.running = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+    def start(self, run, on_done=None):
+        """run(user) is the coroutine per poll, on_done(uid) fires after each one."""
+        self.run = run
+        self.on_done = on_done
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    def submit(self, user: dict, rerun: bool = False) -> bool:
+        """
+        Queues a poll. Skipped if this user is already queued or running;
+        with 'rerun' (a push: new mail the running poll may have missed)
+        it is queued again as soon as that one finishes.
+        """
+        uid = user["uid"]
+        if uid in self.pending:
+            if rerun: self.again.add(uid)
+            return False
+        self.pending.add(uid)
+        self.queue.put_nowait((time.monotonic(), user))
+        return True
+
+    async def worker(self):
+        while True:
+            queued_at, user = await self.queue.get()
+            uid = user["uid"]
+
+            wait = time.monotonic() - queued_at
+            self.wait_avg = self.wait_avg * 0.9 + wait * 0.1
+            self.wait_max = max(self.wait_max, wait)
+            POLL_QUEUE_WAIT.observe(wait)
+
+            self.running += 1
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self.run(user), self.deadline)
+                self.completed += 1
+            except asyncio.TimeoutError as e:
+                self.timeouts += 1
+                count_error("poll", e)
+            except Exception as e:
+                self.failures += 1
+                count_error("poll", e)
+                logger.debug(f"Poll failed for {uid}: {e}")
+            finally:
+                POLL_DURATION.observe(time.monotonic() - started)
+                self.running -= 1
+                self.pending.discard(uid)
+                self.queue.task_done()
+                if self.on_done:
+                    try: self.on_done(uid)
+                    except Exception as e: count_error("reschedule", e)
+                if uid in self.again:
+                    self.again.discard(uid)
+                    self.submit(user)
+
+    def stats(self) -> dict:
+        # wait_max is since start; the distribution is in POLL_QUEUE_WAIT
+        return {
+            "concurrency": self.concurrency,
+            "deadline": self.deadline,
+            "queue_depth": self.queue.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "wait_avg": round(self.wait_avg, 4),
+            "wait_max": round(self.wait_max, 4),
+        }
+
+    async def drain(self, timeout: float) -> bool:
+        """Waits for every queued and running poll. False if 'timeout' ran out first."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+EXECUTOR = PollExecutor()
@@ -0,0 +1,145 @@
+import re
+from collections import namedtuple
+
+# code: the OTP, app: sender/brand name (or None), score: how sure we are,
+# confident: True when a template matched or one candidate clearly wins
+OtpMatch = namedtuple("OtpMatch", "code app score confident")
+
+# --- SENDER TEMPLATES ---
+# (app name, sender domains, code pattern for that sender or None)
+# Known senders are matched on the From address; if the template finds a
+# code it wins outright, otherwise the generic scorer below is used.
+SENDER_RULES = [
+    ("Google", ["google.com"], r"\bG-(\d{6})\b"),
+    ("Facebook", ["facebookmail.com", "facebook.com"], r"\b(?:FB-)?(\d{5,8}) is your"),
+    ("Instagram", ["instagram.com"], r"\b(\d{6})\b(?= is your Instagram)"),
+    ("WhatsApp", ["whatsapp.com"], r"\b(\d{3}-\d{3})\b"),
+    ("Microsoft", ["microsoft.com", "microsoftonline.com", "live.com"], r"Security code:\s*(\d{4,8})"),
+    ("Telegram", ["telegram.org"], r"(?:Login code|Code)[:\s]+(\d{5,6})\b"),
+    ("Apple", ["apple.com"], r"verification code(?: is)?:?\s*(\d{6})\b"),
+    ("Amazon", ["amazon.com", "amazon.in", "amazon.co.uk"], None),
+    ("Netflix", ["netflix.com"], None),
+    ("TikTok", ["tiktok.com"], r"\b(\d{6})\b(?= is your verification code)"),
+    ("X", ["x.com", "twitter.com"], None),
+    ("Discord", ["discord.com"], None),
+]
+
+# --- GENERIC RULE TABLES ---
+KEYWORDS = [
+    "code", "codes", "otp", "passcode", "pin", "verification", "verify",
+    "one-time", "one time", "security code", "login code", "confirm", "কোড",
+]
+# Words that make a nearby number NOT an OTP
+NEGATIVE_WORDS = [
+    "order", "invoice", "zip", "postal", "tracking", "ref", "reference",
+    "account ending", "phone", "tel", "call", "amount", "total", "price",
+]
+BRANDS = [name for name, _, _ in SENDER_RULES]
+
+KEYWORD_BEFORE = 40   # chars between a keyword and a code after it
+KEYWORD_AFTER = 30    # chars between a code and a keyword after it ("123456 is your code")
+NEGATIVE_BEFORE = 15
+MIN_SCORE = 3         # below this a number is never reported (no keyword near it)
+CONFIDENT_SCORE = 3
+CONFIDENT_MARGIN = 2
+
+def _alternation(words):
+    return "|".join(re.escape(w).replace(r"\ ", r"\s+").replace(r"\-", r"[-\s]?") for w in sorted(words, key=len, reverse=True))
+
+def _build_tables():
+    global SENDER_MATCHER, TEMPLATES, TOKENS
+
+    # One regex for all sender domains; m.lastgroup says which rule hit
+    SENDER_MATCHER = re.compile("|".join(
+        f"(?P<r{i}>(?<=[@.])(?:{'|'.join(re.escape(d) for d in domains)})\\b)"
+        for i, (_, domains, _) in enumerate(SENDER_RULES)
+    ), re.I)
+    TEMPLATES = [re.compile(p, re.I) if p else None for _, _, p in SENDER_RULES]
+
+    # Single-pass tokenizer: keywords, negative words, brand names and
+    # code candidates (4-8 digits or "123-456"), skipping numbers glued to
+    # currency, '#', decimals, dates, times and longer digit runs.
+    # "Code:482913" / "OTP=482913" are fine; "12:3045" / "1=2345" are not.
+    TOKENS = re.compile(
+        rf"(?P<kw>\b(?:{_alternation(KEYWORDS)})\b)"
+        rf"|(?P<neg>\b(?:{_alternation(NEGATIVE_WORDS)})\b)"
+        rf"|(?P<brand>\b(?:{_alternation(BRANDS)})\b)"
+        r"|(?P<num>(?<![\w#$€£¥৳\"'/.,-])(?<!\d[:=])(?:\d{3}[- ]\d{3}|\d{4,8})(?![\w%/]|[.,:-]\d))",
+        re.I
+    )
+
+def register_sender(app: str, domains: list, pattern: str = None):
+    """Adds (or extends) a per-sender rule at runtime."""
+    SENDER_RULES.append((app, list(domains), pattern))
+    if app not in BRANDS: BRANDS.append(app)
+    _build_tables()
+
+_build_tables()
+
+def match_sender(sender: str):
+    """Returns the SENDER_RULES index for a From header, or None."""
+    if not sender: return None
+    m = SENDER_MATCHER.search(sender)
+    return int(m.lastgroup[1:]) if m else None
+
+def _clean(code: str) -> str:
+    return code.replace("-", "").replace(" ", "")
+
+def _base_score(code: str) -> float:
+    score = 1.0
+    if len(code) == 6: score += 1
+    # Looks like a year
+    if len(code) == 4 and code[:2] in ("19", "20"): score -= 2
+    # 0000, 1111, ...
+    if len(set(code)) == 1: score -= 1
+    return score
+
+def extract_otp(text: str, sender: str = None):
+    """
+    Finds the most likely OTP in 'text'. Returns an OtpMatch or None.
+    """
+    if not text: return None
+
+    rule = match_sender(sender)
+    app = SENDER_RULES[rule][0] if rule is not None else None
+
+    # 1. Sender template (exact format, no guessing)
+    if rule is not None and TEMPLATES[rule]:
+        m = TEMPLATES[rule].search(text)
+        if m:
+            code = next(g for g in m.groups() if g)
+            return OtpMatch(_clean(code), app, 10.0, True)
+
+    # 2. Generic: one pass, scoring each candidate by keyword proximity
+    candidates = []   # [start, end, code, score]
+    last_kw = last_neg = None
+    for m in TOKENS.finditer(text):
+        kind = m.lastgroup
+        if kind == "kw":
+            last_kw = m.end()
+            # Codes shortly BEFORE this keyword ("482913 is your code")
+            for c in candidates:
+                gap = m.start() - c[1]
+                if 0 <= gap <= KEYWORD_AFTER:
+                    c[3] += 3 - gap / KEYWORD_AFTER
+        elif kind == "neg":
+            last_neg = m.end()
+        elif kind == "brand":
+            if app is None: app = next(b for b in BRANDS if b.lower() == m.group().lower())
+        else:
+            code = _clean(m.group())
+            score = _base_score(code)
+            if last_kw is not None and m.start() - last_kw <= KEYWORD_BEFORE:
+                score += 4 - (m.start() - last_kw) / KEYWORD_BEFORE
+            if last_neg is not None and m.start() - last_neg <= NEGATIVE_BEFORE:
+                score -= 4
+            candidates.append([m.start(), m.end(), code, score])
+
+    if not candidates: return None
+
+    # Highest score wins; on a tie the earlier one
+    best = max(candidates, key=lambda c: (c[3], -c[0]))
+    if best[3] < MIN_SCORE: return None
+    runner_up = max((c[3] for c in candidates if c is not best and c[2] != best[2]), default=None)
+    confident = best[3] >= CONFIDENT_SCORE and (runner_up is None or best[3] - runner_up >= CONFIDENT_MARGIN)
+    return OtpMatch(best[2], app, round(best[3], 2), confident)
@@ -0,0 +1,556 @@
+"""
+Local stand-ins for the external services, so the bot can be exercised
+without Google, Pub/Sub, Telegram or MongoDB (see benchmark.py).
+
+Fake push sender (posts a Pub/Sub-style envelope to /gmail/push):
+    python fakes.py push http://localhost:8080/gmail/push user@gmail.com 12345 [token]
+
+Fake Gmail API (messages.get + batch endpoint) on a local port:
+    python fakes.py gmail 9090
+    GMAIL_BATCH_URL=http://localhost:9090/batch/gmail/v1 python main.py
+
+Fake Gmail + Bot API on one port, with seeded mailboxes, latency and errors:
+    python fakes.py stack 9090 --users 1000 --mailbox 20 --latency 0.05 --error-rate 0.01
+    GMAIL_API_ROOT=http://localhost:9090 python main.py
+
+In-memory MongoDB: database.set_client(MemoryMongoClient()) before the
+other bot modules are imported (benchmark.py does this)
+"""
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+from types import SimpleNamespace
+from itertools import count
+from aiohttp import web
+from base64 import b64encode, urlsafe_b64encode
+from email import message_from_bytes
+from bson import ObjectId
+from pymongo.errors import OperationFailure, DuplicateKeyError
+
+# --- FAKE PUB/SUB PUSH SENDER ---
+def push_envelope(email: str, history_id) -> dict:
+    """Builds the body Pub/Sub sends for a Gmail users.watch notification."""
+    data = json.dumps({"emailAddress": email, "historyId": str(history_id)}).encode()
+    return {
+        "message": {
+            "data": b64encode(data).decode(),
+            "messageId": str(int(time.time() * 1000)),
+            "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "subscription": "projects/local/subscriptions/fake-gmail-push",
+    }
+
+async def send_push(url: str, email: str, history_id, token: str = "", session=None):
+    """Posts one fake push. Returns the HTTP status the bot answered with."""
+    params = {"token": token} if token else None
+    if session is None:
+        async with aiohttp.ClientSession() as s:
+            return await send_push(url, email, history_id, token, session=s)
+    async with session.post(url, json=push_envelope(email, history_id), params=params) as r:
+        return r.status
+
+# --- FAKE GMAIL API ---
+def otp_email(code: str, sender: str = "Google <no-reply@accounts.google.com>", padding: int = 0) -> bytes:
+    """A plain-text verification mail, optionally padded to a realistic size."""
+    body = f"Your verification code is {code}. It expires in 10 minutes."
+    if padding: body += "\r\n\r\n" + ("Lorem ipsum dolor sit amet. " * (padding // 28 + 1))[:padding]
+    return f"From: {sender}\r\nSubject: Your verification code\r\n\r\n{body}".encode()
+
+class FakeGmail:
+    """
+    In-memory Gmail API. Mailboxes are keyed by access token.
+    Serves messages.get (raw/metadata), messages.list, history.list,
+    getProfile and the multipart/mixed batch endpoint.
+    'latency' (seconds, +/-50%) is added to every HTTP request and
+    'error_rate' of them answer 500 instead.
+    """
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.mailboxes = {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ids = count(1)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+
+    def mailbox(self, token: str) -> dict:
+        box = self.mailboxes.get(token)
+        if box is None:
+            box = self.mailboxes[token] = {"messages": {}, "history": [], "history_id": 1000}
+        return box
+
+    def add_message(self, token: str, mid: str, raw: bytes, unread: bool = True, internal_ms: int = None):
+        parsed = message_from_bytes(raw)
+        body = parsed.get_payload() if not parsed.is_multipart() else ""
+        box = self.mailbox(token)
+        box["history_id"] += 1
+        box["messages"][mid] = {
+            "id": mid,
+            "raw": urlsafe_b64encode(raw).decode(),
+            "snippet": " ".join(str(body).split())[:200],
+            "payload": {"headers": [{"name": k, "value": v} for k, v in parsed.items()]},
+            "labelIds": ["INBOX", "UNREAD"] if unread else ["INBOX"],
+            "internalDate": str(internal_ms or int(time.time() * 1000)),
+        }
+        box["history"].append((box["history_id"], mid))
+        return box["history_id"]
+
+    def deliver(self, token: str, raw: bytes) -> dict:
+        """A new mail arrives now. Returns its id and internalDate."""
+        mid = f"m{next(self.ids):x}"
+        self.add_message(token, mid, raw)
+        return {"id": mid, "internalDate": self.mailbox(token)["messages"][mid]["internalDate"]}
+
+    def seed(self, tokens, mailbox_size: int = 0, padding: int = 0):
+        """Creates mailboxes, each with 'mailbox_size' old (read) mails."""
+        old = int((time.time() - 7 * 86400) * 1000)
+        for token in tokens:
+            self.mailbox(token)
+            for _ in range(mailbox_size):
+                self.add_message(token, f"m{next(self.ids):x}", otp_email("000000", padding=padding), unread=False, internal_ms=old)
+
+    def get_message(self, token: str, mid: str, fmt: str = "raw"):
+        if token not in self.mailboxes:
+            return 401, {"error": {"code": 401, "message": "Invalid Credentials"}}
+        msg = self.mailboxes[token]["messages"].get(mid)
+        if not msg:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        common = {"id": mid, "labelIds": msg["labelIds"], "internalDate": msg["internalDate"]}
+        if fmt == "metadata":
+            return 200, {**common, "snippet": msg["snippet"], "payload": msg["payload"]}
+        return 200, {**common, "raw": msg["raw"]}
+
+    def list_messages(self, token: str, query: dict):
+        if token not in self.mailboxes:
+            return 401, {"error": {"code": 401, "message": "Invalid Credentials"}}
+        messages = list(self.mailboxes[token]["messages"].values())
+        if "is:unread" in query.get("q", ""):
+            messages = [m for m in messages if "UNREAD" in m["labelIds"]]
+        messages.sort(key=lambda m: int(m["internalDate"]), reverse=True)
+        limit = int(query.get("maxResults", 100))
+        return 200, {"messages": [{"id": m["id"]} for m in messages[:limit]], "resultSizeEstimate": len(messages)}
+
+    def history(self, token: str, query: dict):
+        if token not in self.mailboxes:
+            return 401, {"error": {"code": 401, "message": "Invalid Credentials"}}
+        box = self.mailboxes[token]
+        start = int(query.get("startHistoryId", 0))
+        records = [
+            {"id": str(hid), "messagesAdded": [{"message": {"id": mid, "labelIds": box["messages"][mid]["labelIds"]}}]}
+            for hid, mid in box["history"] if hid > start
+        ]
+        return 200, {"history": records, "historyId": str(box["history_id"])}
+
+    def profile(self, token: str):
+        if token not in self.mailboxes:
+            return 401, {"error": {"code": 401, "message": "Invalid Credentials"}}
+        box = self.mailboxes[token]
+        return 200, {"emailAddress": f"{token}@example.com", "historyId": str(box["history_id"]), "messagesTotal": len(box["messages"])}
+
+    @staticmethod
+    def token_of(auth_header: str) -> str:
+        return auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def _failed(self) -> bool:
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def _answer(self, request, call):
+        self.requests += 1
+        await self._delay()
+        if self._failed():
+            return web.json_response({"error": {"code": 500, "message": "Backend Error"}}, status=500)
+        status, body = call(self.token_of(request.headers.get("Authorization", "")))
+        return web.json_response(body, status=status)
+
+    async def handle_get(self, request):
+        mid, fmt = request.match_info["mid"], request.query.get("format", "raw")
+        return await self._answer(request, lambda token: self.get_message(token, mid, fmt))
+
+    async def handle_list(self, request):
+        return await self._answer(request, lambda token: self.list_messages(token, request.query))
+
+    async def handle_history(self, request):
+        return await self._answer(request, lambda token: self.history(token, request.query))
+
+    async def handle_profile(self, request):
+        return await self._answer(request, self.profile)
+
+    async def handle_batch(self, request):
+        self.requests += 1
+        self.batches += 1
+        await self._delay()
+        m = re.search(r'boundary="?([^";]+)"?', request.headers.get("Content-Type", ""))
+        if not m:
+            return web.Response(status=400)
+
+        text = (await request.text()).replace("\r\n", "\n")
+        out_boundary = "batch_fake_response"
+        parts = []
+        for chunk in text.split(f"--{m.group(1)}"):
+            chunk = chunk.strip("\n")
+            if not chunk or chunk.startswith("--"): continue
+            part_head, _, http = chunk.partition("\n\n")
+            cid = re.search(r"Content-ID:\s*<([^>]+)>", part_head, re.I)
+            lines = http.split("\n")
+            path = lines[0].split()[1]
+            auth = next((l.split(":", 1)[1].strip() for l in lines[1:] if l.lower().startswith("authorization:")), "")
+
+            mid = re.search(r"/messages/([^/?]+)", path)
+            fmt = "metadata" if "format=metadata" in path else "raw"
+            if self._failed():
+                status, body = 500, {"error": {"code": 500, "message": "Backend Error"}}
+            else:
+                status, body = self.get_message(self.token_of(auth), mid.group(1), fmt) if mid else (404, {})
+            parts.append(
+                f"--{out_boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{cid.group(1) if cid else ''}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(body)}\r\n"
+            )
+        parts.append(f"--{out_boundary}--\r\n")
+        return web.Response(
+            text="".join(parts),
+            headers={"Content-Type": f"multipart/mixed; boundary={out_boundary}"}
+        )
+
+    # --- Control endpoints (benchmark.py) ---
+    async def handle_deliver(self, request):
+        """POST {"token": ..., "code": ..., "sender": ..., "padding": ...} -> new unread mail."""
+        data = await request.json()
+        raw = otp_email(data["code"], data.get("sender") or "Google <no-reply@accounts.google.com>", data.get("padding", 0))
+        return web.json_response(self.deliver(data["token"], raw))
+
+    async def handle_seed(self, request):
+        data = await request.json()
+        self.seed(data["tokens"], data.get("mailbox", 0), data.get("padding", 0))
+        return web.json_response({"mailboxes": len(self.mailboxes)})
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "batches": self.batches, "errors": self.errors, "mailboxes": len(self.mailboxes)}
+
+    def register(self, app: web.Application):
+        app.router.add_get("/gmail/v1/users/me/messages/{mid}", self.handle_get)
+        app.router.add_get("/gmail/v1/users/me/messages", self.handle_list)
+        app.router.add_get("/gmail/v1/users/me/history", self.handle_history)
+        app.router.add_get("/gmail/v1/users/me/profile", self.handle_profile)
+        app.router.add_post("/batch/gmail/v1", self.handle_batch)
+        app.router.add_post("/_admin/gmail/deliver", self.handle_deliver)
+        app.router.add_post("/_admin/gmail/seed", self.handle_seed)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        self.register(app)
+        return app
+
+# --- FAKE TELEGRAM BOT API ---
+class FakeBotApi:
+    """
+    Answers Bot API calls (POST /bot<token>/<method>) like Telegram would
+    and records every sent/edited message with the time it arrived.
+    Use with: Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.message_ids = count(1000)
+        self.calls = {}
+        self.edits = []
+        self.deletes = []
+
+    def _message(self, chat_id, message_id, text=None) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text or "",
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        try:
+            data = dict(await request.post())
+            if not data and request.can_read_body: data = await request.json()
+        except ValueError: data = {}
+        except ConnectionResetError:
+            # The bot closed its session mid-call (shutdown)
+            return web.Response(status=499)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == "sendMessage":
+            result = self._message(data.get("chat_id", 0), next(self.message_ids), data.get("text"))
+        elif method == "editMessageText":
+            self.edits.append((str(data.get("chat_id")), data.get("text", ""), time.time()))
+            result = self._message(data.get("chat_id", 0), int(data.get("message_id", 0)), data.get("text"))
+        elif method == "deleteMessage":
+            self.deletes.append((str(data.get("chat_id")), int(data.get("message_id", 0))))
+            result = True
+        else:
+            # answerCallbackQuery, deleteWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "edits": len(self.edits)}
+
+    def register(self, app: web.Application):
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/_admin/telegram/stats", self.handle_stats)
+
+# --- IN-MEMORY MONGODB ---
+# Just enough of motor's API for this bot: equality / $in / $lt / $lte /
+# $gt / $gte / $ne / $exists / $or filters, $set / $inc / $setOnInsert
+# updates, projections, upserts and bulk_write(UpdateOne). Equality
+# lookups on a few hot fields use a hash index.
+INDEXED_FIELDS = ("_id", "uid", "key", "state", "email")
+MISSING = object()
+
+def _matches(doc: dict, query: dict) -> bool:
+    for field, cond in query.items():
+        if field == "$or":
+            if not any(_matches(doc, q) for q in cond): return False
+            continue
+        if field == "$and":
+            if not all(_matches(doc, q) for q in cond): return False
+            continue
+        value = doc.get(field, MISSING)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$exists":
+                    if (value is not MISSING) != bool(arg): return False
+                elif op == "$ne":
+                    if value == arg or (arg is None and value is MISSING): return False
+                elif op == "$in":
+                    if value is MISSING or value not in arg: return False
+                elif value is MISSING or value is None:
+                    return False
+                elif op == "$lt" and not value < arg: return False
+                elif op == "$lte" and not value <= arg: return False
+                elif op == "$gt" and not value > arg: return False
+                elif op == "$gte" and not value >= arg: return False
+        elif cond is None:
+            if value is not MISSING and value is not None: return False
+        elif value != cond:
+            return False
+    return True
+
+def _project(doc: dict, projection) -> dict:
+    if not projection: return dict(doc)
+    if any(v for k, v in projection.items() if k != "_id"):
+        out = {k: doc[k] for k, v in projection.items() if v and k in doc}
+        if projection.get("_id", 1) and "_id" in doc: out["_id"] = doc["_id"]
+        return out
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    async def to_list(self, length=None):
+        return self.docs[:length] if length else list(self.docs)
+
+class MemoryCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.docs = {}
+        self.index = {f: {} for f in INDEXED_FIELDS}
+
+    # --- internals ---
+    def _candidates(self, query: dict):
+        for field in INDEXED_FIELDS:
+            cond = query.get(field, MISSING)
+            if cond is MISSING or isinstance(cond, dict): continue
+            return [self.docs[i] for i in self.index[field].get(cond, ()) if i in self.docs]
+        cond = query.get("key")
+        if isinstance(cond, dict) and "$in" in cond:
+            ids = set()
+            for k in cond["$in"]: ids.update(self.index["key"].get(k, ()))
+            return [self.docs[i] for i in ids if i in self.docs]
+        return list(self.docs.values())
+
+    def _find(self, query: dict) -> list:
+        return [d for d in self._candidates(query or {}) if _matches(d, query or {})]
+
+    def _reindex(self, doc: dict, remove: bool = False):
+        for field in INDEXED_FIELDS:
+            if field not in doc: continue
+            ids = self.index[field].setdefault(doc[field], set())
+            if remove: ids.discard(doc["_id"])
+            else: ids.add(doc["_id"])
+
+    def _insert(self, doc: dict) -> dict:
+        doc = dict(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} _id: {doc['_id']!r}", 11000)
+        self.docs[doc["_id"]] = doc
+        self._reindex(doc)
+        return doc
+
+    def _apply(self, doc: dict, update: dict, inserting: bool = False):
+        self._reindex(doc, remove=True)
+        doc.update(update.get("$set", {}))
+        if inserting: doc.update(update.get("$setOnInsert", {}))
+        for k, v in update.get("$inc", {}).items():
+            doc[k] = doc.get(k, 0) + v
+        self._reindex(doc)
+
+    def _upsert(self, query: dict, update: dict) -> dict:
+        seed = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        doc = self._insert(seed)
+        self._apply(doc, update, inserting=True)
+        return doc
+
+    def _update(self, query, update, upsert=False, many=False):
+        found = self._find(query)
+        if not many: found = found[:1]
+        for doc in found:
+            self._apply(doc, update)
+        upserted = None
+        if not found and upsert:
+            upserted = self._upsert(query, update)["_id"]
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found), upserted_id=upserted)
+
+    # --- motor API ---
+    async def find_one(self, query=None, projection=None):
+        found = self._find(query or {})
+        return _project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor([_project(d, projection) for d in self._find(query or {})])
+
+    async def insert_one(self, doc: dict):
+        return SimpleNamespace(inserted_id=self._insert(doc)["_id"])
+
+    async def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert, many=True)
+
+    async def find_one_and_update(self, query, update, upsert=False, projection=None, return_document=False):
+        found = self._find(query)
+        if found:
+            doc = found[0]
+            before = dict(doc)
+            self._apply(doc, update)
+            return _project(doc if return_document else before, projection)
+        if not upsert: return None
+        doc = self._upsert(query, update)
+        return _project(doc, projection) if return_document else None
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self._update(op._filter, op._doc, op._upsert)
+        return SimpleNamespace(acknowledged=True)
+
+    async def delete_one(self, query):
+        found = self._find(query)[:1]
+        for doc in found:
+            self._reindex(doc, remove=True)
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(found))
+
+    async def delete_many(self, query):
+        found = self._find(query)
+        for doc in found:
+            self._reindex(doc, remove=True)
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(found))
+
+    async def create_index(self, *args, **kwargs):
+        return "fake_index"
+
+    def watch(self, *args, **kwargs):
+        # Like a standalone mongod: the registry falls back to polling
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", 40573)
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    __getattr__ = __getitem__
+
+class MemoryMongoClient:
+    """Drop-in for AsyncIOMotorClient (see database.set_client)"""
+    def __init__(self, uri: str = None, **kwargs):
+        self.databases = {}
+
+    def close(self):
+        pass
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase()
+        return self.databases[name]
+
+# --- CLI ---
+def stack_app(latency: float = 0.0, error_rate: float = 0.0, bot_latency: float = 0.0):
+    """Fake Gmail + fake Bot API on one aiohttp app."""
+    gmail, telegram = FakeGmail(latency, error_rate), FakeBotApi(bot_latency)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    gmail.register(app)
+    telegram.register(app)
+    app.router.add_get("/_admin/gmail/stats", lambda request: web.json_response(gmail.stats()))
+    return app, gmail, telegram
+
+def run_stack(argv):
+    parser = argparse.ArgumentParser(prog="fakes.py stack")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--users", type=int, default=0, help="mailboxes tok-0..tok-N-1 to create")
+    parser.add_argument("--mailbox", type=int, default=0, help="old mails per mailbox")
+    parser.add_argument("--padding", type=int, default=0, help="extra body bytes per mail")
+    parser.add_argument("--latency", type=float, default=0.0, help="Gmail latency per request (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Gmail requests answering 500")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="Bot API latency per call (s)")
+    args = parser.parse_args(argv)
+
+    app, gmail, _ = stack_app(args.latency, args.error_rate, args.bot_latency)
+    gmail.seed([f"tok-{i}" for i in range(args.users)], args.mailbox, args.padding)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=lambda *_: print("READY", flush=True), access_log=None)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 5 and sys.argv[1] == "push":
+        token = sys.argv[5] if len(sys.argv) > 5 else ""
+        status = asyncio.run(send_push(sys.argv[2], sys.argv[3], sys.argv[4], token))
+        print(f"Push delivered -> HTTP {status}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "gmail":
+        gmail = FakeGmail()
+        gmail.add_message("test-token", "m1", b"Subject: Your code\r\n\r\nYour verification code is 482913")
+        web.run_app(gmail.app(), port=int(sys.argv[2]))
+    elif len(sys.argv) >= 3 and sys.argv[1] == "stack":
+        run_stack(sys.argv[2:])
+    else:
+        print(__doc__)
@@ -1,7 +1,6 @@
 import random
 import time
 import datetime
-import aiohttp
 import re
 from urllib.parse import unquote
 from aiogram import Router, F, Bot
@@ -12,10 +11,18 @@ from aiogram.filters import Command
 from database import update_user, get_user, delete_user_data
 from keyboards import get_main_menu, get_dashboard_ui, get_account_kb
 from services import update_live_ui, process_user
-from auth import get_flow
+from scheduler import mark_hot
+from registry import REGISTRY
+from push import forget_uid
+from http_client import get_session
+from outbox import OUTBOX
+from metrics import count_error
+from tokens import exchange_code, expiry_from, USERINFO_URL
 
 router = Router()
 BD_TZ = datetime.timezone(datetime.timedelta(hours=6))
+# Redirect used by the copy-paste login links (overrides the Railway URL)
+MANUAL_REDIRECT_URI = "http://localhost"
 
 # --- HELPER: Code Hunter (For Manual Fallback) ---
 def extract_google_code(text):
@@ -39,10 +46,7 @@ async def check_login(bot: Bot, uid: str, message: Message = None):
     user = await get_user(uid)
     if not user or not user.get("email"):
         text, kb = await get_dashboard_ui(uid)
-        if message:
-            await message.answer(text, reply_markup=kb, parse_mode="HTML")
-        else:
-            await bot.send_message(uid, text, reply_markup=kb, parse_mode="HTML")
+        await OUTBOX.send(bot, uid, text=text, reply_markup=kb, parse_mode="HTML")
         return False
     return True
 
@@ -51,16 +55,15 @@ async def refresh_and_repost(bot: Bot, uid: str):
     user = await get_user(uid)
     
     if user and user.get("main_msg_id"):
-        try: await bot.delete_message(chat_id=uid, message_id=user["main_msg_id"])
+        try: await OUTBOX.delete(bot, uid, user["main_msg_id"])
         except: pass
     
-    sent = await bot.send_message(uid, "🔄 <b>Syncing...</b>", parse_mode="HTML")
+    sent = await OUTBOX.send(bot, uid, text="🔄 <b>Syncing...</b>", parse_mode="HTML")
     await update_user(uid, {"main_msg_id": sent.message_id})
     
     try:
-        async with aiohttp.ClientSession() as s: 
-            await process_user(bot, uid, s, manual=True)
-    except: pass
+        await process_user(bot, uid, get_session(), manual=True)
+    except Exception as e: count_error("manual_refresh", e)
     finally:
         await update_live_ui(bot, uid)
 
@@ -76,7 +79,7 @@ async def cmd_start(message: Message, bot: Bot):
     # 2. CLEANUP: Delete Old Dashboard (if it exists)
     if user and user.get("main_msg_id"):
         try:
-            await bot.delete_message(chat_id=uid, message_id=user["main_msg_id"])
+            await OUTBOX.delete(bot, uid, user["main_msg_id"])
         except:
             pass 
 
@@ -95,24 +98,26 @@ async def cmd_start(message: Message, bot: Bot):
                 "last_gen_timestamp": time.time(),
                 "is_active": True
             })
-        except:
+            mark_hot(uid)
+        except Exception as e:
+            count_error("start_gen_alias", e)
             await update_user(uid, {"is_active": True})
     else:
         await update_user(uid, {"is_active": True}) 
     
     # 4. UI PART 1: Send the Main Menu (The Bottom Buttons)
     # We send a text message with 'reply_markup=get_main_menu()' to open the keyboard.
-    await message.answer("<b>Menu</b>", reply_markup=get_main_menu(), parse_mode="HTML")
+    await OUTBOX.send(bot, uid, text="<b>Menu</b>", reply_markup=get_main_menu(), parse_mode="HTML")
     
     # 5. UI PART 2: Send the Dashboard (The Inline Buttons)
     text, kb = await get_dashboard_ui(uid)
-    sent = await message.answer(text, reply_markup=kb, parse_mode="HTML")
+    sent = await OUTBOX.send(bot, uid, text=text, reply_markup=kb, parse_mode="HTML")
     
     # 6. Save new Message ID (So we can refresh the Dashboard later)
     await update_user(uid, {"main_msg_id": sent.message_id})
 
     # 7. Delete the user's "/start" command to keep chat clean
-    try: await message.delete()
+    try: await OUTBOX.delete(bot, uid, message.message_id)
     except: pass
 
 
@@ -134,7 +139,7 @@ async def btn_account(message: Message, bot: Bot):
         f"📧 <b>Email:</b> <code>{email}</code>\n"
         f"────────────────"
     )
-    await message.answer(report, reply_markup=get_account_kb(), parse_mode="HTML")
+    await OUTBOX.send(bot, uid, text=report, reply_markup=get_account_kb(), parse_mode="HTML")
 
 
 
@@ -143,26 +148,29 @@ async def btn_refresh(message: Message, bot: Bot):
     uid = str(message.from_user.id)
     if not await check_login(bot, uid, message): return
     
-    try: await message.delete()
+    try: await OUTBOX.delete(bot, uid, message.message_id)
     except: pass
 
+    # User is waiting for a mail -> poll this mailbox fast for a while
+    mark_hot(uid)
+
     user = await get_user(uid)
     
     if user and user.get("main_msg_id"):
         try:
-            await bot.edit_message_text(
-                chat_id=uid, 
-                message_id=user["main_msg_id"], 
+            await OUTBOX.edit(
+                bot,
+                uid, 
+                user["main_msg_id"], 
                 text="🔄 <b>Syncing...</b>", 
                 parse_mode="HTML"
             )
         except: pass
 
     try:
-        async with aiohttp.ClientSession() as s: 
-            await process_user(bot, uid, s, manual=True)
-    except: 
-        pass
+        await process_user(bot, uid, get_session(), manual=True)
+    except Exception as e:
+        count_error("manual_refresh", e)
     finally:
         await update_live_ui(bot, uid)
 
@@ -181,38 +189,41 @@ async def handle_manual_code_paste(message: Message, bot: Bot):
         return
 
     # 3. Code found -> Manual Login Logic
-    status = await message.answer("🔄 <b>Verifying Manual Code...</b>")
+    status = await OUTBOX.send(bot, uid, text="🔄 <b>Verifying Manual Code...</b>")
     try:
-        # We retrieve the flow but we MUST force localhost for manual copy-paste
-        flow = get_flow(state=uid)
-        flow.redirect_uri = "http://localhost"  # Override Railway URL for manual mode
+        # Async exchange on the shared client (never blocks the event loop).
+        # We MUST force localhost for manual copy-paste.
+        token_data = await exchange_code(get_session(), code, MANUAL_REDIRECT_URI)
+        if "error" in token_data:
+            raise Exception(token_data.get("error_description") or token_data["error"])
+        access_token = token_data["access_token"]
         
-        flow.fetch_token(code=code)
-        creds = flow.credentials
+        headers = {"Authorization": f"Bearer {access_token}"}
+        async with get_session().get(USERINFO_URL, headers=headers) as r:
+            profile = await r.json()
+        user_name = profile.get("name", "User")
         
-        async with aiohttp.ClientSession() as s:
-            headers = {"Authorization": f"Bearer {creds.token}"}
-            async with s.get("https://www.googleapis.com/oauth2/v1/userinfo?alt=json", headers=headers) as r:
-                profile = await r.json()
-                user_name = profile.get("name", "User")
-                
-                await update_user(uid, {
-                    "email": profile.get("email"), 
-                    "name": user_name,
-                    "access": creds.token, 
-                    "refresh": creds.refresh_token,
-                    "captured": 0, 
-                    "is_active": True, 
-                    "history_id": None
-                })
+        await update_user(uid, {
+            "email": profile.get("email"), 
+            "name": user_name,
+            "google_token": token_data,
+            "access": access_token, 
+            "access_expires_at": expiry_from(token_data),
+            "refresh": token_data.get("refresh_token"),
+            "captured": 0, 
+            "is_active": True, 
+            "history_id": None
+        })
+        # The email may have changed: pushes re-resolve it
+        forget_uid(uid)
         
-        await status.edit_text(f"✅ <b>Manual Login Success!</b>\nWelcome, {user_name}!")
+        await OUTBOX.edit(bot, uid, status.message_id, text=f"✅ <b>Manual Login Success!</b>\nWelcome, {user_name}!")
         await refresh_and_repost(bot, uid)
-        try: await message.delete()
+        try: await OUTBOX.delete(bot, uid, message.message_id)
         except: pass
         
     except Exception as e: 
-        await status.edit_text(f"❌ <b>Manual Login Failed:</b>\n{str(e)}\n\n(Ensure you used the 'localhost' link if pasting manually)")
+        await OUTBOX.edit(bot, uid, status.message_id, text=f"❌ <b>Manual Login Failed:</b>\n{str(e)}\n\n(Ensure you used the 'localhost' link if pasting manually)")
 
 # --- CALLBACK QUERY HANDLERS ---
 
@@ -225,8 +236,8 @@ async def callbacks(q: CallbackQuery, bot: Bot):
         user = await get_user(uid)
         if not user or not user.get("email"):
             text, kb = await get_dashboard_ui(uid)
-            try: await q.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
-            except: await bot.send_message(uid, text, reply_markup=kb, parse_mode="HTML")
+            try: await OUTBOX.edit(bot, uid, q.message.message_id, text=text, reply_markup=kb, parse_mode="HTML")
+            except: await OUTBOX.send(bot, uid, text=text, reply_markup=kb, parse_mode="HTML")
             await q.answer()
             return
     
@@ -247,6 +258,7 @@ async def callbacks(q: CallbackQuery, bot: Bot):
                 "latest_otp": formatted_status, 
                 "last_gen_timestamp": time.time()
             })
+            mark_hot(uid)
             await update_live_ui(bot, uid)
             
     elif action == "ui_clear":
@@ -260,18 +272,20 @@ async def callbacks(q: CallbackQuery, bot: Bot):
         main_id = user.get("main_msg_id") if user else None
         
         await delete_user_data(uid)
+        # Stop polling now instead of waiting for the change event
+        REGISTRY.discard(uid)
         
         login_text, login_kb = await get_dashboard_ui(uid)
         if main_id:
-            try: await bot.edit_message_text(text=login_text, chat_id=uid, message_id=main_id, reply_markup=login_kb, parse_mode="HTML")
+            try: await OUTBOX.edit(bot, uid, main_id, text=login_text, reply_markup=login_kb, parse_mode="HTML")
             except: pass
         else:
-             await bot.send_message(uid, login_text, reply_markup=login_kb, parse_mode="HTML")
+             await OUTBOX.send(bot, uid, text=login_text, reply_markup=login_kb, parse_mode="HTML")
 
-        try: await q.message.delete()
+        try: await OUTBOX.delete(bot, uid, q.message.message_id)
         except: pass
         
     elif action == "ui_back":
         await q.answer()
-        try: await q.message.delete()
+        try: await OUTBOX.delete(bot, uid, q.message.message_id)
         except: pass
\ No newline at end of file
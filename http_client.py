@@ -0,0 +1,37 @@
+import aiohttp
+from config import HTTP_POOL_LIMIT, HTTP_PER_HOST_LIMIT, HTTP_KEEPALIVE, HTTP_DNS_TTL
+
+# --- SHARED HTTP CLIENT ---
+# One pooled session for the whole process (Gmail, OAuth, userinfo).
+# Opened/closed by main.main(); reusing it keeps TLS connections warm,
+# so a manual Refresh or a login doesn't pay a fresh handshake.
+_SESSION = None
+
+def _build_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_PER_HOST_LIMIT,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+async def start_http():
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = _build_session()
+    return _SESSION
+
+def get_session():
+    """Returns the shared session (created on first use if main didn't yet)."""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = _build_session()
+    return _SESSION
+
+async def close_http():
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
@@ -1,18 +1,20 @@
-import time
-import uuid
 import logging
+from functools import lru_cache
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, CopyTextButton
-from database import get_user, db
-from auth import get_flow
+from database import get_user
+from auth import get_login_url
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+# Keyboards are built once and reused; they are never mutated after creation
+@lru_cache(maxsize=1)
 def get_main_menu():
     return ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="👤 Account"), KeyboardButton(text="↻ Refresh")]
     ], resize_keyboard=True)
 
+@lru_cache(maxsize=1)
 def get_account_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔌 Logout", callback_data="ui_logout")],
@@ -30,37 +32,15 @@ async def get_dashboard_ui(uid_str: str, user_data: dict = None):
     else:
         user = await get_user(uid_str)
     
-    # CASE 1: User NOT logged in (Generate the Login Link)
+    # CASE 1: User NOT logged in (Show the Login Link)
     if not user or not user.get("email"):
-        # 1. Generate a unique "Secret ID" (State)
-        state_token = uuid.uuid4().hex
-        
-        # 2. SAVE to Database
+        # Reuses this user's recent state; the URL comes from a pre-built template
         try:
-            # Note: We save uid as INT here, Netlify will convert to String later.
-            # The new auth.js logic handles this mismatch perfectly.
-            await db.oauth_states.insert_one({
-                "state": state_token,
-                "user_id": int(uid_str),
-                "created_at": time.time()
-            })
+            auth_url = await get_login_url(uid_str)
         except Exception as e:
             logger.error(f"Error saving state: {e}")
-        
-        # 3. Generate Link (FORCE STATE)
-        flow = get_flow(state=state_token)
-        
-        # Pass state explicitly
-        auth_url, _ = flow.authorization_url(prompt='consent', state=state_token)
-        
-        text = (
-            "<b>🔒 AUTHENTICATION REQUIRED</b>\n"
-            "────────────────────────\n"
-            "Click the button below to connect your Gmail account.\n"
-            "You will be redirected to Google and then automatically back here.\n"
-            "────────────────────────"
-        )
-        return text, InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🚀 Connect Gmail", url=auth_url)]])
+            return LOGIN_TEXT, None
+        return LOGIN_TEXT, _login_kb(auth_url)
 
     # CASE 2: User IS logged in (Show Dashboard)
     latest_otp_text = user.get("latest_otp", "<i>...</i>")
@@ -73,8 +53,7 @@ async def get_dashboard_ui(uid_str: str, user_data: dict = None):
         f"────────────────"
     )
 
-    kb_rows = []
-    
+    label = None
     if raw_otp:
         otp_ts = user.get("last_otp_timestamp", 0)
         gen_ts = user.get("last_gen_timestamp", 0)
@@ -84,7 +63,27 @@ async def get_dashboard_ui(uid_str: str, user_data: dict = None):
             label = f"🚨 Last: {raw_otp}"
         else:
             label = f"✨ New: {raw_otp}"
-            
+
+    return text, _dashboard_kb(label, raw_otp, gen_alias)
+
+LOGIN_TEXT = (
+    "<b>🔒 AUTHENTICATION REQUIRED</b>\n"
+    "────────────────────────\n"
+    "Click the button below to connect your Gmail account.\n"
+    "You will be redirected to Google and then automatically back here.\n"
+    "────────────────────────"
+)
+
+@lru_cache(maxsize=1024)
+def _login_kb(auth_url):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🚀 Connect Gmail", url=auth_url)]])
+
+@lru_cache(maxsize=4096)
+def _dashboard_kb(label, raw_otp, gen_alias):
+    """Same buttons -> same keyboard object (no rebuild per refresh)."""
+    kb_rows = []
+    
+    if raw_otp:
         kb_rows.append([InlineKeyboardButton(text=label, copy_text=CopyTextButton(text=raw_otp))])
         
     if gen_alias:
@@ -94,4 +93,4 @@ async def get_dashboard_ui(uid_str: str, user_data: dict = None):
         InlineKeyboardButton(text="🔄 Gen New", callback_data="ui_gen")
     ])
 
-    return text, InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    return InlineKeyboardMarkup(inline_keyboard=kb_rows)
@@ -1,20 +1,40 @@
+import time
+import signal
 import asyncio
 import logging
 import sys
-import os
-import aiohttp
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 # --- IMPORTS ---
-from config import BOT_TOKEN, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, INSTANCE_ID, PORT
-from database import db, update_user
+from config import (
+    BOT_TOKEN, REDIRECT_URI, INSTANCE_ID, PORT, HANDOVER_TIMEOUT,
+    TG_UPDATE_MODE, TG_WEBHOOK_PATH, TG_WEBHOOK_URL, TG_WEBHOOK_SECRET
+)
+from database import db, update_user, ensure_indexes, WRITE_BEHIND
 from handlers import router, refresh_and_repost
 # --- ADDED: process_user and update_live_ui for direct editing ---
 from services import background_watcher, process_user, update_live_ui 
+from push import handle_gmail_push, watch_renewer, forget_uid
+from http_client import start_http, close_http, get_session
+from tokens import expiry_from, exchange_code, USERINFO_URL
+from outbox import OUTBOX
+from auth import ensure_auth_indexes
+from partitions import LEASES
+from registry import REGISTRY
+from executor import EXECUTOR
+from offload import OFFLOAD
+from metrics import handle_metrics, register_stats, count_error
+from scheduler import SCHEDULER
+from tokens import TOKENS
+from batch import BATCHER
+from database import USER_CACHE, SEEN_INDEX
+from mime import MIME_STATS
+from services import FETCH_STATS
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -33,20 +53,12 @@ async def handle_google_callback(request):
         return web.Response(text="❌ Error: Session expired. Please try again from the bot.")
         
     user_id = str(oauth_record['user_id'])
+    # Links are single-use: the next login screen gets a fresh state
+    await db.oauth_states.delete_one({"state": state})
 
     # 2. Exchange Code for Token
-    token_url = "https://oauth2.googleapis.com/token"
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "code": code,
-        "grant_type": "authorization_code",
-        "redirect_uri": REDIRECT_URI,
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(token_url, data=data) as resp:
-            token_data = await resp.json()
+    session = get_session()
+    token_data = await exchange_code(session, code, REDIRECT_URI)
 
     if "error" in token_data:
         return web.Response(text=f"❌ Google Error: {token_data.get('error_description')}")
@@ -58,12 +70,11 @@ async def handle_google_callback(request):
     user_email = "Connected"
     user_name = "User"
     try:
-        async with aiohttp.ClientSession() as s:
-            async with s.get("https://www.googleapis.com/oauth2/v1/userinfo?alt=json", headers=headers) as r:
-                profile = await r.json()
-                user_email = profile.get("email", user_email)
-                user_name = profile.get("name", user_name)
-    except: pass
+        async with session.get(USERINFO_URL, headers=headers) as r:
+            profile = await r.json()
+            user_email = profile.get("email", user_email)
+            user_name = profile.get("name", user_name)
+    except Exception as e: count_error("oauth_userinfo", e)
 
     # 4. Clean up Old UI 
     # We do NOT delete the old message anymore. We will edit it below.
@@ -73,12 +84,16 @@ async def handle_google_callback(request):
     await update_user(user_id, {
         "google_token": token_data,
         "access": access_token,
+        "access_expires_at": expiry_from(token_data),
         "refresh": token_data.get("refresh_token"),
         "email": user_email,
         "name": user_name,
         "is_active": True,
-        "captured": 0
+        "captured": 0,
+        "history_id": None
     })
+    # The email may have changed: pushes re-resolve it
+    forget_uid(user_id)
     
     # 6. Notify Telegram User (EDIT LOGIC)
     ui_updated = False
@@ -91,9 +106,10 @@ async def handle_google_callback(request):
         if msg_id:
             # Step B: Show "Syncing" status on the existing message
             try:
-                await bot.edit_message_text(
-                    chat_id=user_id, 
-                    message_id=msg_id, 
+                await OUTBOX.edit(
+                    bot,
+                    user_id, 
+                    msg_id, 
                     text=f"✅ <b>Login Successful!</b>\nConnected: {user_email}\n🔄 Syncing emails...", 
                     parse_mode="HTML"
                 )
@@ -104,8 +120,7 @@ async def handle_google_callback(request):
 
             # Step C: Fetch Data and Update to Dashboard
             if ui_updated:
-                async with aiohttp.ClientSession() as s: 
-                    await process_user(bot, user_id, s, manual=True)
+                await process_user(bot, user_id, session, manual=True)
                 await update_live_ui(bot, user_id)
 
     except Exception as e:
@@ -115,9 +130,9 @@ async def handle_google_callback(request):
     # 7. Fallback (If edit failed, use old method)
     if not ui_updated:
         try:
-            await bot.send_message(user_id, f"✅ <b>Login Successful!</b>\nConnected: {user_email}", parse_mode="HTML")
+            await OUTBOX.send(bot, user_id, text=f"✅ <b>Login Successful!</b>\nConnected: {user_email}", parse_mode="HTML")
             await refresh_and_repost(bot, user_id)
-        except: pass
+        except Exception as e: count_error("oauth_login_notice", e)
 
     # 8. THE NEW "ZENOX MAIL" CONNECTED PAGE
     bot_username = request.app.get('bot_username', 'GmailBot')
@@ -230,33 +245,118 @@ async def handle_google_callback(request):
     """
     return web.Response(text=html, content_type='text/html')
 
-# --- CONFLICT MONITOR ---
-async def monitor_deployment_conflict():
-    lock_col = db['server_lock']
+# --- METRICS ---
+def register_metrics():
+    """Exports every component's stats() as gauges on /metrics."""
+    register_stats("registry", lambda: {"active_users": len(REGISTRY.users), "version": REGISTRY.version})
+    register_stats("scheduler", SCHEDULER.stats)
+    register_stats("executor", EXECUTOR.stats)
+    register_stats("leases", LEASES.stats)
+    register_stats("user_cache", USER_CACHE.stats)
+    register_stats("seen_index", SEEN_INDEX.stats)
+    register_stats("write_behind", WRITE_BEHIND.stats)
+    register_stats("tokens", TOKENS.stats)
+    register_stats("batch", BATCHER.stats)
+    register_stats("outbox", OUTBOX.stats)
+    register_stats("offload", OFFLOAD.stats)
+    register_stats("mime", lambda: MIME_STATS)
+    register_stats("fetch", lambda: FETCH_STATS)
+
+# --- TELEGRAM LEADER ---
+def webhook_mode() -> bool:
+    return TG_UPDATE_MODE == "webhook"
+
+async def run_telegram(dp, bot):
+    """
+    Telegram allows one getUpdates consumer per bot, so only the instance
+    holding the leader lease long-polls. The others keep polling Gmail for
+    their partitions and serving /auth/google and /gmail/push, and take
+    over if the leader goes away.
+    In webhook mode every instance serves the update route; the leader only
+    (re)registers the webhook URL.
+    """
     while True:
+        await LEASES.wait_leader()
+        if LEASES.retiring: return
+
+        if webhook_mode():
+            try:
+                await bot.set_webhook(TG_WEBHOOK_URL, secret_token=TG_WEBHOOK_SECRET, drop_pending_updates=False)
+                logger.info(f"📡 Telegram webhook set to {TG_WEBHOOK_URL}")
+            except Exception as e:
+                logger.error(f"Webhook setup failed: {e}")
+            return
+
+        logger.info(f"📡 Telegram polling on instance {INSTANCE_ID[:8]}")
+        # Keep pending updates: they were sent during the handover gap
+        await bot.delete_webhook(drop_pending_updates=False)
+
+        async def stop_on_loss():
+            await LEASES.lost_leader()
+            try: await dp.stop_polling()
+            except RuntimeError: pass
+        watchdog = asyncio.create_task(stop_on_loss())
         try:
-            lock = await lock_col.find_one({"_id": "process_lock"})
-            if lock and lock.get("active_id") != INSTANCE_ID:
-                logger.warning(f"⚠️ New Instance Detected. Stopping old instance...")
-                os._exit(0)
-        except: pass
-        await asyncio.sleep(10)
+            # Signals are handled by main() (graceful handover)
+            await dp.start_polling(bot, close_bot_session=False, handle_signals=False)
+        finally:
+            watchdog.cancel()
+
+        # Stopped for a handover (not by losing the lease) -> done
+        if LEASES.retiring:
+            return
+
+# --- HANDOVER ---
+async def handover(dp, telegram_task):
+    """
+    Leaves without dropping work (newer deployment ready, or SIGTERM):
+    1. stop taking new polls and hand the Telegram long-poll over first
+    2. finish in-flight polls, queued Telegram edits and buffered writes
+    3. release the partition leases, the successor picks them up within
+       one LEASE_RENEW_INTERVAL
+    """
+    started = time.monotonic()
+    deadline = started + HANDOVER_TIMEOUT
+    LEASES.retire()
+
+    if LEASES.leader and not webhook_mode():
+        try: await dp.stop_polling()
+        except RuntimeError: pass  # Wasn't polling yet
+        try: await asyncio.wait_for(telegram_task, 5)
+        except Exception: telegram_task.cancel()
+        await LEASES.step_down()
+        logger.info(f"🤝 Telegram released after {time.monotonic() - started:.2f}s")
+    else:
+        # Webhook mode: the route keeps answering until the app shuts down
+        telegram_task.cancel()
+        if LEASES.leader: await LEASES.step_down()
+
+    drained = await EXECUTOR.drain(max(0, deadline - time.monotonic()))
+    drained &= await OUTBOX.drain(max(0, deadline - time.monotonic()))
+    await WRITE_BEHIND.flush()
+    await LEASES.stop()
+    logger.info(
+        f"🤝 Handover done in {time.monotonic() - started:.2f}s"
+        + ("" if drained else " (timed out, some work was dropped)")
+    )
 
 # --- MAIN APP ---
 async def main():
     if not BOT_TOKEN:
         sys.exit("❌ Missing BOT_TOKEN")
 
-    # 1. Lock Process
-    await db['server_lock'].update_one(
-        {"_id": "process_lock"}, 
-        {"$set": {"active_id": INSTANCE_ID}}, 
-        upsert=True
-    )
-    logger.info(f"👑 Claimed Lock ID: {INSTANCE_ID[:8]}")
-    await asyncio.sleep(5)
+    # 1. Join the instance group as not-ready (owns nothing until warmed up)
+    await LEASES.start()
+    logger.info(f"👑 Instance {INSTANCE_ID[:8]} joined, warming up...")
+
+    # 2. Shared HTTP client (Gmail, OAuth) for the whole process
+    await start_http()
+    OFFLOAD.start()
+    for setup in (ensure_auth_indexes, ensure_indexes):
+        try: await setup()
+        except Exception as e: logger.error(f"Index setup failed: {e}")
 
-    # 2. Start Bot & Detect Username
+    # 3. Start Bot & Detect Username
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     bot_info = await bot.get_me()
     bot_username = bot_info.username
@@ -265,12 +365,18 @@ async def main():
     dp = Dispatcher(storage=MemoryStorage())
     dp.include_router(router)
 
-    # 3. Start Web Server
+    # 4. Start Web Server
     app = web.Application()
     app['bot'] = bot
     app['bot_username'] = bot_username # Save username for the redirect
     
     app.router.add_get('/auth/google', handle_google_callback)
+    app.router.add_post('/gmail/push', handle_gmail_push)
+    app.router.add_get('/metrics', handle_metrics)
+    register_metrics()
+    if webhook_mode():
+        # Answers Telegram right away, the update is handled in the background
+        SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=TG_WEBHOOK_SECRET).register(app, path=TG_WEBHOOK_PATH)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -279,17 +385,37 @@ async def main():
     
     logger.info(f"🌍 Server listening on Port {PORT}")
 
-    # 4. Start Tasks
-    asyncio.create_task(monitor_deployment_conflict())
+    # 5. Warm caches, start tasks, then announce readiness (older
+    #    instances start draining only once we can take over right away)
+    try: await REGISTRY.start()
+    except Exception as e: logger.error(f"Registry warm-up failed: {e}")
     asyncio.create_task(background_watcher(bot))
+    asyncio.create_task(watch_renewer())
+    asyncio.create_task(WRITE_BEHIND.run())
+    await LEASES.announce_ready()
+
+    # 6. Run until SIGTERM or a newer deployment takes over
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try: loop.add_signal_handler(sig, shutdown.set)
+        except NotImplementedError: pass  # Windows
 
-    # 5. Run
-    await bot.delete_webhook(drop_pending_updates=True)
+    telegram_task = asyncio.create_task(run_telegram(dp, bot))
+    waiters = [asyncio.create_task(shutdown.wait()), asyncio.create_task(LEASES.superseded.wait())]
     try:
-        await dp.start_polling(bot)
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        await handover(dp, telegram_task)
     finally:
-        await bot.session.close()
+        for w in waiters: w.cancel()
+        await LEASES.stop()
+        # Web server first: webhook updates still in flight need the bot session
         await runner.cleanup()
+        await bot.session.close()
+        # Nothing buffered may be lost on shutdown
+        await WRITE_BEHIND.flush()
+        await close_http()
+        OFFLOAD.stop()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,129 @@
+import time
+from aiohttp import web
+
+# Every exported name starts with this
+PREFIX = "gmail_otp"
+
+# Seconds; covers a 20ms batch window up to a 15s poll deadline
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+# Seconds since the mail reached Gmail; hot polls land in the first few,
+# idle users (30s interval) further up
+ARRIVAL_BUCKETS = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 120, 300)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values) -> str:
+    if not names: return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label key -> [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound: row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for key, row in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, row):
+                lines.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {round(row[-2], 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {row[-1]}")
+        return lines
+
+# --- METRICS ---
+WATCHER_CYCLE = Histogram("watcher_cycle_seconds", "Time spent in one watcher tick (sync + dispatch)")
+POLL_LAG = Histogram("poll_lag_seconds", "How late a poll started compared to its scheduled time")
+POLL_DURATION = Histogram("poll_duration_seconds", "Duration of one process_user run")
+POLL_QUEUE_WAIT = Histogram("poll_queue_wait_seconds", "Time a due poll waited in the executor queue")
+GMAIL_CALLS = Counter("gmail_requests_total", "Gmail API calls by call and HTTP status", ("call", "status"))
+GMAIL_LATENCY = Histogram("gmail_request_seconds", "Gmail API call latency", ("call",))
+TOKEN_CALLS = Counter("token_requests_total", "OAuth token endpoint calls", ("kind", "result"))
+TOKEN_LATENCY = Histogram("token_request_seconds", "OAuth token endpoint latency", ("kind",))
+TELEGRAM_CALLS = Counter("telegram_calls_total", "Bot API calls made through the outbox", ("method", "result"))
+OTPS = Counter("otps_captured_total", "OTP codes found and stored")
+OTP_STAGES = Histogram("otp_stage_seconds", "Seconds from Gmail internalDate to each stage of an OTP's delivery", ("stage",), ARRIVAL_BUCKETS)
+ERRORS = Counter("errors_total", "Exceptions caught and swallowed, by place and type", ("where", "type"))
+
+METRICS = [
+    WATCHER_CYCLE, POLL_LAG, POLL_DURATION, POLL_QUEUE_WAIT, GMAIL_CALLS, GMAIL_LATENCY,
+    TOKEN_CALLS, TOKEN_LATENCY, TELEGRAM_CALLS, OTPS, OTP_STAGES, ERRORS,
+]
+
+def count_error(where: str, exc: BaseException = None):
+    """For the places that swallow exceptions: at least leave a trace here."""
+    ERRORS.inc(where=where, type=type(exc).__name__ if exc is not None else "unknown")
+
+def observe_gmail(call: str, status, started: float):
+    GMAIL_CALLS.inc(call=call, status=status if status is not None else "error")
+    GMAIL_LATENCY.observe(time.monotonic() - started, call=call)
+
+# --- stats() GAUGES ---
+# name -> callable returning the component's stats() dict (registered by main)
+STATS_SOURCES = {}
+
+def register_stats(name: str, source):
+    STATS_SOURCES[name] = source
+
+def _flatten(prefix: str, data: dict, out: list):
+    for key, value in data.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            _flatten(name, value, out)
+        elif isinstance(value, bool):
+            out.append((name, int(value)))
+        elif isinstance(value, (int, float)):
+            out.append((name, value))
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for source, fn in STATS_SOURCES.items():
+        try: stats = fn()
+        except Exception as e:
+            count_error("metrics_stats", e)
+            continue
+        gauges = []
+        _flatten(f"{PREFIX}_{source}", stats, gauges)
+        for name, value in gauges:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+# --- WEB SERVER HANDLER ---
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain")
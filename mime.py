@@ -0,0 +1,97 @@
+from base64 import urlsafe_b64decode
+from html import unescape
+from html.parser import HTMLParser
+from email.parser import BytesFeedParser
+from config import MIME_BYTE_BUDGET, MIME_TEXT_LIMIT
+
+# --- STATS ---
+MIME_STATS = {"messages": 0, "bytes_decoded": 0, "truncated": 0, "html_stripped": 0}
+
+class _TextExtractor(HTMLParser):
+    """Streaming HTML -> text. Drops <script>/<style> and stops once 'limit' chars are collected."""
+    SKIP = {"script", "style", "head", "title"}
+    BREAKS = {"br", "p", "div", "tr", "td", "li", "h1", "h2", "h3", "table"}
+
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.size = 0
+        self.skipping = 0
+        self.chunks = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP: self.skipping += 1
+        elif tag in self.BREAKS: self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping: self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.skipping or self.size >= self.limit: return
+        data = data[:self.limit - self.size]
+        self.chunks.append(data)
+        self.size += len(data)
+
+    @property
+    def full(self):
+        return self.size >= self.limit
+
+def html_to_text(html: str, limit: int = MIME_TEXT_LIMIT, chunk: int = 8192) -> str:
+    parser = _TextExtractor(limit)
+    for i in range(0, len(html), chunk):
+        parser.feed(html[i:i + chunk])
+        if parser.full: break
+    parser.close()
+    return unescape("".join(parser.chunks))
+
+def _decode_prefix(raw: str, budget: int):
+    """
+    base64url -> bytes, but never more than 'budget' bytes.
+    Text parts come first in virtually every mail, so the cut only loses
+    the tail (attachments). Returns (bytes, truncated).
+    """
+    max_chars = (budget // 3) * 4
+    truncated = len(raw) > max_chars
+    chunk = raw[:max_chars] if truncated else raw
+    chunk += "=" * (-len(chunk) % 4)
+    return urlsafe_b64decode(chunk), truncated
+
+def _part_text(part, limit: int) -> str:
+    payload = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset() or "utf-8"
+    try: return payload[:limit * 4].decode(charset, errors="ignore")
+    except LookupError: return payload[:limit * 4].decode("utf-8", errors="ignore")
+
+def parse_raw(raw: str, budget: int = MIME_BYTE_BUDGET, limit: int = MIME_TEXT_LIMIT):
+    """
+    Turns a Gmail format=raw payload into (sender, text, bytes_decoded).
+    - decodes at most 'budget' bytes of the message
+    - walks the MIME tree ONCE: first text/plain wins, first text/html is
+      the fallback, attachments and binary parts are never decoded
+    - HTML is stripped to text before OTP matching
+    text is None if the message has no usable text part.
+    """
+    data, truncated = _decode_prefix(raw, budget)
+    parser = BytesFeedParser()
+    parser.feed(data)
+    msg = parser.close()
+
+    MIME_STATS["messages"] += 1
+    MIME_STATS["bytes_decoded"] += len(data)
+    if truncated: MIME_STATS["truncated"] += 1
+
+    sender = msg.get("From", "")
+    html_part = None
+    for part in msg.walk():
+        if part.is_multipart(): continue
+        if part.get_content_disposition() == "attachment": continue
+        ctype = part.get_content_type()
+        if ctype == "text/plain":
+            return sender, _part_text(part, limit)[:limit], len(data)
+        if ctype == "text/html" and html_part is None:
+            html_part = part
+
+    if html_part is not None:
+        MIME_STATS["html_stripped"] += 1
+        return sender, html_to_text(_part_text(html_part, limit * 4), limit), len(data)
+    return sender, None, len(data)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import OFFLOAD_MODE, OFFLOAD_WORKERS, OFFLOAD_MIN_BYTES, OFFLOAD_MAX_PENDING
+from mime import parse_raw, MIME_STATS
+from extractor import extract_otp
+
+logger = logging.getLogger(__name__)
+
+def scan_raw(raw: str):
+    """Gmail format=raw payload -> (sender, OtpMatch or None). Pure CPU work."""
+    sender, text, _ = parse_raw(raw)
+    if not text: return sender, None
+    return sender, extract_otp(text, sender)
+
+def _scan_in_worker(raw: str):
+    # Runs in a child process: send the MIME_STATS increments back with the result
+    before = dict(MIME_STATS)
+    result = scan_raw(raw)
+    return result, {k: MIME_STATS[k] - before[k] for k in MIME_STATS}
+
+class CpuOffload:
+    """
+    Moves raw-message parsing off the event loop, so a burst of big mails
+    doesn't delay Telegram updates and the OAuth callback.
+    - only the (sender, OtpMatch) result crosses back, never the text
+    - payloads under 'min_bytes' stay inline (the hop costs more)
+    - at most 'max_pending' messages are in the pool; callers beyond that
+      wait for a slot instead of queueing unbounded work
+    Child processes have their own copy of extractor.py's tables: senders
+    added with register_sender() at runtime only apply to inline parses.
+    """
+    def __init__(self, mode: str = OFFLOAD_MODE, workers: int = OFFLOAD_WORKERS,
+                 min_bytes: int = OFFLOAD_MIN_BYTES, max_pending: int = OFFLOAD_MAX_PENDING):
+        self.mode = mode
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pool = None
+        self.in_pool = 0
+
+        # --- Stats ---
+        self.inline = 0
+        self.offloaded = 0
+        self.waits = 0
+        self.failures = 0
+
+    def start(self):
+        if self.pool is not None or self.mode not in ("process", "thread"): return
+        if self.mode == "process":
+            # spawn: forking a process that runs motor/aiohttp threads isn't safe
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="mime")
+        logger.info(f"🧮 CPU offload: {self.mode} pool with {self.workers} worker(s)")
+
+    async def scan(self, raw: str):
+        if self.pool is None or len(raw) < self.min_bytes:
+            self.inline += 1
+            return scan_raw(raw)
+
+        if self.slots.locked(): self.waits += 1
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            pool = self.pool
+            self.in_pool += 1
+            try:
+                if self.mode == "process":
+                    result, delta = await loop.run_in_executor(pool, _scan_in_worker, raw)
+                    for k, v in delta.items(): MIME_STATS[k] += v
+                else:
+                    result = await loop.run_in_executor(pool, scan_raw, raw)
+            except BrokenProcessPool:
+                # A worker died (OOM?) -> rebuild the pool, parse this one here.
+                # Other scans on the same pool fail too: only the first rebuilds.
+                self.failures += 1
+                if self.pool is pool:
+                    self.stop()
+                    self.start()
+                self.inline += 1
+                return scan_raw(raw)
+            finally:
+                self.in_pool -= 1
+        self.offloaded += 1
+        return result
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode if self.pool is not None else "off",
+            "workers": self.workers,
+            "in_pool": self.in_pool,
+            "inline": self.inline,
+            "offloaded": self.offloaded,
+            "waits": self.waits,
+            "failures": self.failures,
+        }
+
+OFFLOAD = CpuOffload()
@@ -0,0 +1,259 @@
+import time
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramNetworkError
+from config import TG_GLOBAL_RATE, TG_GLOBAL_BURST, TG_CHAT_RATE, TG_CHAT_BURST, TG_MAX_RETRIES
+from metrics import TELEGRAM_CALLS
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        """Telegram said 'retry after N seconds'."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            wait = self.blocked_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst and self.blocked_until <= time.monotonic()
+
+class _Job:
+    __slots__ = ("method", "kwargs", "futures", "key", "attempts", "kind")
+
+    def __init__(self, method, kwargs, key=None, kind="call"):
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = []
+        self.key = key
+        self.attempts = 0
+        self.kind = kind
+
+# Remembered message renders (for no-op edit suppression)
+RENDER_MEMORY = 50000
+# 429s from this many chats within FLOOD_WINDOW seconds = a bot-wide flood
+# wait: every chat pauses, not just the ones that were told to
+FLOOD_CHATS = 3
+FLOOD_WINDOW = 1.0
+
+def render_key(kwargs: dict):
+    """What the user sees: text + keyboard. Equal keys = identical message."""
+    markup = kwargs.get("reply_markup")
+    return hash((kwargs.get("text"), markup.model_dump_json(exclude_none=True) if markup else None))
+
+def _quiet(fut):
+    # Fire-and-forget callers never read errors; don't warn about them
+    if not fut.cancelled(): fut.exception()
+
+class Outbox:
+    """
+    Every Bot API call that sends/edits/deletes in a chat goes through here.
+    - global token bucket (Telegram: ~30 msg/s per bot)
+    - per-chat token bucket (~1 msg/s per chat, small bursts allowed)
+    - TelegramRetryAfter is honored (the chat waits that long, the whole
+      bot when several chats get it at once) and the call is retried,
+      not dropped
+    - pending edits of the same message are coalesced: only the newest
+      text is sent, and every caller gets that result
+    """
+    def __init__(self):
+        self.bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.queues = {}
+        self.drainers = {}
+        # (chat, message_id) -> queued edit job not sent yet
+        self.pending_edits = {}
+        # (chat, message_id) -> render_key of what Telegram currently shows
+        self.rendered = OrderedDict()
+        # chat -> when it last got a 429 (monotonic)
+        self.flooded = {}
+
+        # --- Stats ---
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self.unchanged = 0
+        self.global_pauses = 0
+
+    def _retry_after(self, chat: str, bucket: TokenBucket, seconds: float):
+        bucket.pause(seconds)
+        now = time.monotonic()
+        self.flooded[chat] = now
+        for c in [c for c, at in self.flooded.items() if now - at > FLOOD_WINDOW]:
+            del self.flooded[c]
+        if len(self.flooded) >= FLOOD_CHATS:
+            self.bucket.pause(seconds)
+            self.global_pauses += 1
+
+    def _enqueue(self, chat_id, job: _Job):
+        chat = str(chat_id)
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_quiet)
+        job.futures.append(fut)
+        self.queues.setdefault(chat, deque()).append(job)
+        if chat not in self.drainers:
+            self.drainers[chat] = asyncio.create_task(self._drain(chat))
+        return fut
+
+    def call(self, chat, method, **kwargs):
+        """Queues any Bot API coroutine method for this chat. Returns a future."""
+        return self._enqueue(chat, _Job(method, kwargs))
+
+    def send(self, bot, chat_id, **kwargs):
+        return self._enqueue(chat_id, _Job(bot.send_message, dict(chat_id=chat_id, **kwargs), kind="send"))
+
+    def delete(self, bot, chat_id, message_id):
+        self.rendered.pop((str(chat_id), message_id), None)
+        return self.call(chat_id, bot.delete_message, chat_id=chat_id, message_id=message_id)
+
+    def _remember(self, key, kwargs):
+        self.rendered[key] = render_key(kwargs)
+        self.rendered.move_to_end(key)
+        while len(self.rendered) > RENDER_MEMORY:
+            self.rendered.popitem(last=False)
+
+    def edit(self, bot, chat_id, message_id, **kwargs):
+        key = (str(chat_id), message_id)
+        job = self.pending_edits.get(key)
+
+        # Telegram already shows exactly this -> skip the round trip
+        # (it would only answer "message is not modified")
+        if not job and self.rendered.get(key) == render_key(kwargs):
+            self.unchanged += 1
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result(True)
+            return fut
+
+        if job:
+            # Not sent yet -> just swap in the newer content
+            job.kwargs = dict(chat_id=chat_id, message_id=message_id, **kwargs)
+            fut = asyncio.get_running_loop().create_future()
+            fut.add_done_callback(_quiet)
+            job.futures.append(fut)
+            self.coalesced += 1
+            return fut
+
+        job = _Job(bot.edit_message_text, dict(chat_id=chat_id, message_id=message_id, **kwargs), key)
+        self.pending_edits[key] = job
+        return self._enqueue(chat_id, job)
+
+    async def _drain(self, chat: str):
+        queue = self.queues[chat]
+        bucket = self.chat_buckets.get(chat) or self.chat_buckets.setdefault(chat, TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST))
+        try:
+            while queue:
+                job = queue[0]
+                await bucket.acquire()
+                await self.bucket.acquire()
+
+                # From here on, new edits for this message queue a new job
+                if job.key: self.pending_edits.pop(job.key, None)
+                job.attempts += 1
+                method = getattr(job.method, "__name__", "call")
+                try:
+                    result = await job.method(**job.kwargs)
+                except TelegramRetryAfter as e:
+                    TELEGRAM_CALLS.inc(method=method, result="retry_after")
+                    self.retried += 1
+                    self._retry_after(chat, bucket, e.retry_after)
+                    if job.key:
+                        newer = self.pending_edits.get(job.key)
+                        if newer:
+                            # A newer edit of this message is queued: it replaces this one
+                            newer.futures.extend(job.futures)
+                            queue.popleft()
+                            continue
+                        self.pending_edits[job.key] = job
+                    continue
+                except TelegramNetworkError as e:
+                    TELEGRAM_CALLS.inc(method=method, result="network_error")
+                    if job.attempts < TG_MAX_RETRIES:
+                        self.retried += 1
+                        await asyncio.sleep(job.attempts)
+                        continue
+                    self._finish(queue, job, error=e)
+                except TelegramBadRequest as e:
+                    # Same content again is not a failure
+                    if "message is not modified" in str(e):
+                        TELEGRAM_CALLS.inc(method=method, result="not_modified")
+                        if job.key: self._remember(job.key, job.kwargs)
+                        self._finish(queue, job, result=True)
+                    else:
+                        TELEGRAM_CALLS.inc(method=method, result="bad_request")
+                        self._finish(queue, job, error=e)
+                except Exception as e:
+                    TELEGRAM_CALLS.inc(method=method, result="error")
+                    self._finish(queue, job, error=e)
+                else:
+                    TELEGRAM_CALLS.inc(method=method, result="ok")
+                    self.sent += 1
+                    if job.key:
+                        self._remember(job.key, job.kwargs)
+                    elif job.kind == "send" and hasattr(result, "message_id"):
+                        self._remember((chat, result.message_id), job.kwargs)
+                    self._finish(queue, job, result=result)
+        finally:
+            del self.drainers[chat]
+            if not queue: self.queues.pop(chat, None)
+            # Forget rate state of quiet chats so the dict doesn't grow forever
+            if len(self.chat_buckets) > 10000:
+                for c in [c for c, b in self.chat_buckets.items() if c not in self.drainers and b.idle]:
+                    del self.chat_buckets[c]
+
+    def _finish(self, queue, job, result=None, error=None):
+        queue.popleft()
+        if error is not None:
+            self.failed += 1
+            logger.debug(f"Telegram call failed: {error}")
+        for fut in job.futures:
+            if fut.done(): continue
+            if error is not None: fut.set_exception(error)
+            else: fut.set_result(result)
+
+    async def drain(self, timeout: float) -> bool:
+        """Waits until every queued Telegram call went out. False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self.drainers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            await asyncio.wait(list(self.drainers.values()), timeout=remaining)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(len(q) for q in self.queues.values()),
+            "chats": len(self.drainers),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "failed": self.failed,
+            "unchanged": self.unchanged,
+            "global_pauses": self.global_pauses,
+        }
+
+OUTBOX = Outbox()
@@ -0,0 +1,295 @@
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import PARTITIONS, LEASE_TTL, LEASE_RENEW_INTERVAL, INSTANCE_ID, DEPLOYMENT_ID
+from database import leases, workers, server_lock, deployments
+
+logger = logging.getLogger(__name__)
+
+def partition_of(uid: str) -> int:
+    return zlib.crc32(str(uid).encode()) % PARTITIONS
+
+def _weight(partition: int, worker: str) -> int:
+    # crc32 is linear, so its ranking barely changes between similar ids
+    return int.from_bytes(hashlib.blake2b(f"{partition}:{worker}".encode(), digest_size=8).digest(), "big")
+
+def assign(partition_count: int, members: list) -> dict:
+    """
+    Rendezvous hashing: partition -> worker id. Every instance computes the
+    same answer from the same member list, and a join/leave only moves the
+    partitions that belonged to (or now go to) that one worker.
+    """
+    if not members: return {}
+    return {p: max(members, key=lambda w: _weight(p, w)) for p in range(partition_count)}
+
+class PartitionLeases:
+    """
+    Splits the user base between running instances.
+    - every instance heartbeats into 'workers'
+    - the live member list decides who SHOULD own each partition
+    - ownership is a renewable lease in 'partition_leases'; a partition is
+      only taken over once its old lease was released or has expired, so
+      two instances never poll the same user
+    The Telegram long-poll (only one getUpdates consumer per bot) is a
+    separate lease on the old 'process_lock' document.
+
+    Deploys hand over instead of overlapping: a new instance joins as
+    not-ready (owns nothing) while it warms up, then announces readiness.
+    Instances of older deployments see that, stop taking new work, drain,
+    and release their leases (see main.handover).
+    """
+    def __init__(self, instance_id: str = INSTANCE_ID, partitions: int = PARTITIONS, ttl: float = LEASE_TTL):
+        self.instance_id = instance_id
+        self.partitions = partitions
+        self.ttl = ttl
+        self.started_at = time.time()
+        # When this DEPLOYMENT_ID first came up (shared by all its replicas)
+        self.deployed_at = None
+        self.owned = set()
+        self.members = []
+        self.leader = False
+        # Bumped whenever 'owned' changes so the watcher knows when to resync
+        self.version = 0
+        self.leader_event = asyncio.Event()
+        self.task = None
+
+        # --- Handover ---
+        self.ready = False
+        self.ready_at = None
+        self.taken_over = False
+        # Set when a newer deployment is up and warm
+        self.superseded = asyncio.Event()
+        # Leases still held (and renewed) while draining after retire()
+        self.retiring = False
+        self.held = set()
+
+        # --- Stats ---
+        self.rebalances = 0
+        self.claim_conflicts = 0
+
+    def owns(self, uid: str) -> bool:
+        return partition_of(uid) in self.owned
+
+    def mine(self, user_list: list) -> list:
+        return [u for u in user_list if partition_of(u["uid"]) in self.owned]
+
+    # --- Membership ---
+    async def deployment_started(self) -> float:
+        """
+        First start of any instance of this deployment. A replica of an old
+        deploy restarting later (crash, OOM) still counts as old.
+        """
+        if self.deployed_at is None:
+            try:
+                doc = await deployments.find_one_and_update(
+                    {"_id": DEPLOYMENT_ID}, {"$setOnInsert": {"started_at": self.started_at}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # Another replica inserted it at the same moment
+                doc = await deployments.find_one({"_id": DEPLOYMENT_ID})
+            self.deployed_at = doc["started_at"]
+        return self.deployed_at
+
+    async def heartbeat(self):
+        now = time.time()
+        deployed_at = await self.deployment_started()
+        await workers.update_one(
+            {"_id": self.instance_id},
+            {"$set": {"seen_at": now, "ready": self.ready, "deployment": DEPLOYMENT_ID, "deployed_at": deployed_at},
+             "$setOnInsert": {"started_at": self.started_at}},
+            upsert=True
+        )
+        live = [w async for w in workers.find({"seen_at": {"$gte": now - self.ttl}})]
+        # Crashed instances never say goodbye
+        await workers.delete_many({"seen_at": {"$lt": now - self.ttl * 10}})
+        return live
+
+    @staticmethod
+    def members_of(live: list) -> list:
+        """Ready instances of the newest deployment: they split the partitions."""
+        ready = [w for w in live if w.get("ready")]
+        if not ready: return []
+        # By deployment age, not instance age: see deployment_started()
+        newest = max(ready, key=lambda w: w.get("deployed_at", w.get("started_at", 0))).get("deployment")
+        return sorted(w["_id"] for w in ready if w.get("deployment") == newest)
+
+    # --- Leases ---
+    async def claim(self, partition: int) -> bool:
+        now = time.time()
+        try:
+            doc = await leases.find_one_and_update(
+                {"_id": partition, "$or": [{"owner": self.instance_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.instance_id, "expires_at": now + self.ttl}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return bool(doc) and doc.get("owner") == self.instance_id
+        except DuplicateKeyError:
+            # Someone else holds a live lease
+            self.claim_conflicts += 1
+            return False
+
+    async def renew(self, partitions) -> bool:
+        """One write for every lease we keep. False if any of them was lost."""
+        res = await leases.update_many(
+            {"_id": {"$in": list(partitions)}, "owner": self.instance_id},
+            {"$set": {"expires_at": time.time() + self.ttl}}
+        )
+        return res.matched_count == len(partitions)
+
+    async def release(self, partitions=None):
+        """Gives leases back right away (all of ours if 'partitions' is None)."""
+        query = {"owner": self.instance_id}
+        if partitions is not None:
+            if not partitions: return
+            query["_id"] = {"$in": list(partitions)}
+        await leases.update_many(query, {"$set": {"expires_at": 0}})
+
+    async def claim_leader(self) -> bool:
+        now = time.time()
+        try:
+            doc = await server_lock.find_one_and_update(
+                {"_id": "process_lock", "$or": [
+                    {"active_id": self.instance_id},
+                    {"expires_at": {"$lt": now}},
+                    {"expires_at": {"$exists": False}},
+                ]},
+                {"$set": {"active_id": self.instance_id, "expires_at": now + self.ttl}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return bool(doc) and doc.get("active_id") == self.instance_id
+        except DuplicateKeyError:
+            return False
+
+    async def release_leader(self):
+        await server_lock.update_one(
+            {"_id": "process_lock", "active_id": self.instance_id},
+            {"$set": {"expires_at": 0}}
+        )
+
+    async def rebalance(self):
+        live = await self.heartbeat()
+        if self.retiring:
+            # Draining: keep what we hold alive, take nothing new
+            if self.held: await self.renew(self.held)
+            return
+
+        self.members = self.members_of(live)
+        if self.ready and self.members and self.instance_id not in self.members:
+            # A newer deployment is up and warm -> hand everything over
+            if not self.superseded.is_set():
+                logger.info("🤝 Newer deployment is ready, handing over...")
+                self.superseded.set()
+            return
+        target = set()
+        if self.ready:
+            target = {p for p, w in assign(self.partitions, self.members).items() if w == self.instance_id}
+
+        # Give back what now belongs to someone else first, renew what we
+        # keep (one write), then try to claim the rest one by one
+        await self.release(self.owned - target)
+        keep = self.owned & target
+        if keep and not await self.renew(keep):
+            keep = set()  # Lost something (e.g. stalled past the TTL) -> re-claim individually
+        missing = list(target - keep)
+        claimed = await asyncio.gather(*(self.claim(p) for p in missing))
+        owned = keep | {p for p, ok in zip(missing, claimed) if ok}
+
+        if owned != self.owned:
+            logger.info(f"🧩 Partitions: {len(owned)}/{self.partitions} owned, {len(self.members)} instance(s)")
+            self.owned = owned
+            self.version += 1
+            self.rebalances += 1
+        if self.ready_at and not self.taken_over and target and owned == target:
+            self.taken_over = True
+            logger.info(f"🤝 Handover: all {len(owned)} partition(s) owned {time.time() - self.ready_at:.2f}s after ready")
+
+        leader = await self.claim_leader() if self.ready else False
+        if leader != self.leader:
+            if leader and self.ready_at:
+                logger.info(f"👑 Telegram leader lease acquired {time.time() - self.ready_at:.2f}s after ready")
+            else:
+                logger.info("👑 Telegram leader lease acquired" if leader else "⚠️ Telegram leader lease lost")
+            self.leader = leader
+        if leader: self.leader_event.set()
+        else: self.leader_event.clear()
+
+    async def announce_ready(self):
+        """Caches are warm: from now on this instance takes its share."""
+        self.ready = True
+        self.ready_at = time.time()
+        logger.info(f"✅ Instance {self.instance_id[:8]} ready")
+        try: await self.rebalance()
+        except Exception as e: logger.error(f"Lease renewal failed: {e}")
+
+    def retire(self):
+        """Stops taking new work. Leases stay held (and renewed) until stop()."""
+        self.retiring = True
+        self.held = set(self.owned)
+        self.owned = set()
+        self.version += 1
+
+    async def step_down(self):
+        """Gives up the Telegram lease (after polling was stopped)."""
+        self.leader = False
+        self.leader_event.clear()
+        await self.release_leader()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+            try: await self.rebalance()
+            except Exception as e:
+                logger.error(f"Lease renewal failed: {e}")
+                # Can't prove we still hold anything -> stop polling before the TTL runs out
+                if self.owned:
+                    self.owned = set()
+                    self.version += 1
+
+    async def start(self):
+        try: await self.rebalance()
+        except Exception as e: logger.error(f"Lease setup failed: {e}")
+        self.task = asyncio.create_task(self.run())
+
+    async def wait_leader(self):
+        await self.leader_event.wait()
+
+    async def lost_leader(self):
+        """Returns once this instance no longer holds the Telegram lease."""
+        while self.leader:
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+    async def stop(self):
+        """Leaves the group: others can take our partitions immediately."""
+        if self.task: self.task.cancel()
+        try:
+            await self.release()
+            await self.release_leader()
+            await workers.delete_one({"_id": self.instance_id})
+        except Exception as e:
+            logger.error(f"Lease release failed: {e}")
+        self.owned = set()
+        self.held = set()
+        self.leader = False
+        self.version += 1
+
+    def stats(self) -> dict:
+        return {
+            "instance": self.instance_id[:8],
+            "members": len(self.members),
+            "partitions": self.partitions,
+            "owned": len(self.owned),
+            "leader": self.leader,
+            "ready": self.ready,
+            "retiring": self.retiring,
+            "rebalances": self.rebalances,
+            "claim_conflicts": self.claim_conflicts,
+        }
+
+LEASES = PartitionLeases()
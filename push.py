@@ -0,0 +1,174 @@
+import json
+import time
+import asyncio
+import logging
+from base64 import b64decode
+from aiohttp import web
+from config import PUSH_TOPIC, PUSH_TOKEN, PUSH_STALE_AFTER, WATCH_RENEW_MARGIN, GMAIL_API_ROOT
+from database import users, update_user, USER_CACHE
+from http_client import get_session
+from partitions import LEASES
+from executor import EXECUTOR
+from metrics import count_error
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API = f"{GMAIL_API_ROOT}/gmail/v1/users/me"
+
+# --- PUSH STATE (RAM) ---
+# email -> uid, filled lazily from MongoDB (see forget_uid)
+EMAIL_INDEX = {}
+# Last time any push arrived (used to detect a dead subscription)
+LAST_PUSH = {"at": 0.0}
+
+def push_enabled():
+    return bool(PUSH_TOPIC)
+
+def push_alive():
+    """True while pushes keep arriving. Until the first one, we keep polling."""
+    return push_enabled() and (time.time() - LAST_PUSH["at"]) < PUSH_STALE_AFTER
+
+def push_covered(user: dict) -> bool:
+    """
+    True if new mail for this user will arrive as a push, so the watcher
+    only needs a slow safety poll (see scheduler.py). Users without a watch,
+    with an expired watch, or while the push channel is silent are polled
+    as usual.
+    """
+    expires = (user.get("watch_expiration") or 0) / 1000
+    return push_alive() and expires > time.time()
+
+def decode_push(body: dict):
+    """
+    Unpacks a Pub/Sub push envelope:
+    {"message": {"data": base64({"emailAddress": ..., "historyId": ...})}}
+    Returns (email, history_id) or (None, None).
+    """
+    try:
+        data = json.loads(b64decode(body["message"]["data"]))
+        return data.get("emailAddress"), data.get("historyId")
+    except Exception as e:
+        count_error("push_decode", e)
+        return None, None
+
+async def uid_for_email(email: str):
+    if email in EMAIL_INDEX:
+        return EMAIL_INDEX[email]
+    user = await users.find_one({"email": email, "is_active": True}, {"uid": 1})
+    if user:
+        EMAIL_INDEX[email] = user["uid"]
+        return user["uid"]
+    return None
+
+def forget_uid(uid: str):
+    """Drops a user's email mapping (logout, or a login that may change the email)."""
+    for email in [e for e, u in EMAIL_INDEX.items() if u == uid]:
+        del EMAIL_INDEX[email]
+
+def submit_push(uid: str) -> bool:
+    """
+    Queues a mailbox check on the poll executor, like a due poll: it never
+    runs twice at once for a user, and a push arriving while one runs gets
+    exactly one more run. Returns False if this instance doesn't poll the
+    user (another one owns the partition, or it isn't scheduled here yet).
+    """
+    from scheduler import SCHEDULER
+    user = SCHEDULER.users.get(uid)
+    if not user or not LEASES.owns(uid): return False
+    EXECUTOR.submit(user, rerun=True)
+    return True
+
+# --- WEB SERVER HANDLER ---
+async def handle_gmail_push(request):
+    """
+    Pub/Sub push endpoint. Acknowledges fast (Pub/Sub retries on non-2xx),
+    the actual mailbox check runs on the poll executor of whichever
+    instance owns the user.
+    """
+    # config.py refuses to start push mode without a token
+    if not push_enabled() or request.query.get("token") != PUSH_TOKEN:
+        return web.Response(status=403)
+
+    try: body = await request.json()
+    except: return web.Response(status=400)
+
+    LAST_PUSH["at"] = time.time()
+
+    email, history_id = decode_push(body)
+    if not email:
+        return web.Response(status=204)
+
+    uid = await uid_for_email(email)
+    if not uid:
+        return web.Response(status=204)
+
+    # Push for a change we already synced past -> nothing to do
+    cached = USER_CACHE.peek(uid) or {}
+    try:
+        if history_id and cached.get("history_id") and int(history_id) <= int(cached["history_id"]):
+            return web.Response(status=204)
+    except (TypeError, ValueError): pass
+
+    if not submit_push(uid):
+        # Pub/Sub hit an instance that doesn't poll this user: leave a hint
+        # on the user doc, the owner's registry sees it and polls right away
+        # (see PollScheduler.new_push). If even that fails, have it redelivered.
+        try: await update_user(uid, {"push_at": time.time()})
+        except Exception as e:
+            count_error("push_handover", e)
+            return web.Response(status=503)
+    return web.Response(status=204)
+
+# --- WATCH RENEWAL ---
+async def start_watch(uid, user, session):
+    """Calls users.watch for one mailbox and stores the new expiration (ms)."""
+    from services import refresh_google_token, TIMEOUT
+    payload = {"topicName": PUSH_TOPIC, "labelIds": ["INBOX"]}
+
+    for attempt in range(2):
+        headers = {"Authorization": f"Bearer {user.get('access')}"}
+        try:
+            async with session.post(f"{GMAIL_API}/watch", json=payload, headers=headers, timeout=TIMEOUT) as r:
+                if r.status == 401 and attempt == 0:
+                    access = await refresh_google_token(uid, session, user.get("refresh"))
+                    if not access: return False
+                    user["access"] = access
+                    continue
+                if r.status != 200: return False
+                res = await r.json()
+        except Exception as e:
+            count_error("gmail_watch", e)
+            return False
+
+        expiration = int(res.get("expiration", 0))
+        user["watch_expiration"] = expiration
+        await update_user(uid, {"watch_expiration": expiration})
+        return True
+    return False
+
+async def watch_renewer():
+    """
+    Background Worker. Keeps a Gmail watch alive for every active user.
+    Runs once a minute; only users close to expiry hit the API.
+    Each instance renews the watches of its own partitions.
+    """
+    if not push_enabled():
+        return
+    logger.info(f"📬 Gmail push enabled on topic {PUSH_TOPIC}")
+
+    while True:
+        try:
+            deadline = (time.time() + WATCH_RENEW_MARGIN) * 1000
+            cursor = users.find(
+                {"is_active": True, "access": {"$ne": None},
+                 "$or": [{"watch_expiration": {"$exists": False}}, {"watch_expiration": {"$lt": deadline}}]},
+                {"uid": 1, "access": 1, "refresh": 1, "watch_expiration": 1}
+            )
+            async for user in cursor:
+                if not LEASES.owns(user["uid"]): continue
+                await start_watch(user["uid"], user, get_session())
+        except Exception as e:
+            count_error("watch_renewer", e)
+            logger.error(f"Watch renewal failed: {e}")
+
+        await asyncio.sleep(60)
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import logging
+from pymongo.errors import OperationFailure
+from config import REGISTRY_POLL_INTERVAL, REGISTRY_DIFF_INTERVAL
+from database import users, USER_CACHE, WRITE_BEHIND, CACHE_PROJECTION
+from metrics import count_error
+
+logger = logging.getLogger(__name__)
+
+class ActiveUserRegistry:
+    """
+    In-memory set of active users for the watcher.
+    Loaded once at startup, then kept in sync from MongoDB change streams,
+    or (standalone Mongo) from a poll on 'updated_at' plus a periodic uid diff.
+    """
+    def __init__(self):
+        self.users = {}
+        # Mongo _id -> uid, because delete events only carry the _id
+        self.ids = {}
+        # Bumped on every change
+        self.version = 0
+        # uids changed since the watcher last looked, and whether a full
+        # (re)load happened meanwhile (see take_changes)
+        self.changed = set()
+        self.reloaded = False
+        self.mode = None
+        self.task = None
+
+    def apply(self, doc: dict):
+        uid = doc.get("uid")
+        if not uid: return
+        self.ids[doc["_id"]] = uid
+        if doc.get("is_active"):
+            # Mongo may lag behind writes still sitting in the buffer
+            doc = WRITE_BEHIND.overlay(uid, doc)
+            self.users[uid] = doc
+            # Keep the RAM cache as fresh as the old full scan did
+            USER_CACHE.put(uid, doc)
+        else:
+            self.users.pop(uid, None)
+        self.changed.add(uid)
+        self.version += 1
+
+    def remove(self, _id):
+        uid = self.ids.pop(_id, None)
+        if uid: self.discard(uid)
+
+    def discard(self, uid: str):
+        """Drops a user right away (e.g. on logout, before the event arrives)."""
+        if self.users.pop(uid, None) is not None:
+            self.changed.add(uid)
+            self.version += 1
+
+    def snapshot(self) -> list:
+        return list(self.users.values())
+
+    def take_changes(self):
+        """(reloaded, changed uids) since the last call. Lets the watcher apply just those."""
+        reloaded, changed = self.reloaded, self.changed
+        self.reloaded, self.changed = False, set()
+        return reloaded, changed
+
+    async def load(self):
+        fresh = {}
+        async for doc in users.find({"is_active": True}, CACHE_PROJECTION):
+            fresh[doc["uid"]] = doc
+            self.ids[doc["_id"]] = doc["uid"]
+            USER_CACHE.put(doc["uid"], doc)
+        self.users = fresh
+        self.reloaded = True
+        self.version += 1
+        logger.info(f"📇 Registry loaded {len(fresh)} active users")
+
+    async def follow_stream(self):
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+            {"$project": {"fullDocument.google_token": 0}},
+        ]
+        async with users.watch(pipeline, full_document="updateLookup") as stream:
+            self.mode = "change_stream"
+            async for change in stream:
+                if change["operationType"] == "delete":
+                    self.remove(change["documentKey"]["_id"])
+                elif change.get("fullDocument"):
+                    self.apply(change["fullDocument"])
+
+    async def follow_polling(self):
+        self.mode = "polling"
+        since = time.time()
+        last_diff = time.time()
+        while True:
+            await asyncio.sleep(REGISTRY_POLL_INTERVAL)
+            try:
+                cutoff = time.time()
+                # Small overlap so writes landing during the query aren't lost
+                async for doc in users.find({"updated_at": {"$gte": since - 1}}, CACHE_PROJECTION):
+                    self.apply(doc)
+                since = cutoff
+
+                # Deletes leave nothing to query for -> cheap uid-only diff
+                if cutoff - last_diff >= REGISTRY_DIFF_INTERVAL:
+                    last_diff = cutoff
+                    live = {d["uid"] async for d in users.find({"is_active": True}, {"uid": 1})}
+                    for uid in list(self.users.keys() - live):
+                        self.discard(uid)
+            except Exception as e:
+                count_error("registry_poll", e)
+                logger.error(f"Registry poll failed: {e}")
+
+    async def follow(self):
+        while True:
+            try:
+                await self.follow_stream()
+            except OperationFailure as e:
+                # 40573: "The $changeStream stage is only supported on replica sets"
+                if e.code == 40573 or "replica set" in str(e):
+                    logger.info("📇 No change streams on this MongoDB, using polling diff")
+                    await self.follow_polling()
+                    return
+                count_error("registry_stream", e)
+                logger.error(f"Registry stream failed: {e}")
+            except Exception as e:
+                count_error("registry_stream", e)
+                logger.error(f"Registry stream failed: {e}")
+
+            # Stream dropped: reload so nothing missed in between is lost
+            await asyncio.sleep(1)
+            try: await self.load()
+            except Exception as e:
+                count_error("registry_reload", e)
+                logger.error(f"Registry reload failed: {e}")
+
+    async def start(self):
+        if self.task: return  # Already warmed up by main()
+        await self.load()
+        self.task = asyncio.create_task(self.follow())
+
+REGISTRY = ActiveUserRegistry()
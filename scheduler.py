@@ -0,0 +1,171 @@
+import time
+import heapq
+import random
+from config import (
+    POLL_HOT_INTERVAL, POLL_WARM_INTERVAL, POLL_IDLE_INTERVAL,
+    POLL_HOT_WINDOW, POLL_WARM_WINDOW, POLL_JITTER, PUSH_SAFETY_POLL
+)
+from push import push_covered
+from metrics import POLL_LAG
+
+# Poll interval per tier (seconds)
+TIER_INTERVALS = {
+    "hot": POLL_HOT_INTERVAL,
+    "warm": POLL_WARM_INTERVAL,
+    "idle": POLL_IDLE_INTERVAL,
+    "push": PUSH_SAFETY_POLL,
+}
+
+class PollScheduler:
+    """
+    Decides WHEN each active user is polled.
+    A min-heap keyed on next-due time; stale heap entries are skipped lazily
+    (due_at holds the authoritative time for every uid).
+    """
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}
+        self.users = {}
+        self.tiers = {}
+        # uid -> time of the last explicit "poll me now" (Refresh, Gen New)
+        self.boosted = {}
+        # uid -> wall-clock time its current poll was due (for OTP traces)
+        self.fired = {}
+        # uid -> newest 'push_at' hint seen (pushes another instance received)
+        self.pushed = {}
+        # uids with a fresh hint, for the watcher to run like a push (take_pushes)
+        self.push_due = set()
+
+    def tier(self, user: dict) -> str:
+        if push_covered(user):
+            return "push"
+        last_activity = max(
+            user.get("last_gen_timestamp") or 0,
+            user.get("last_otp_timestamp") or 0,
+            self.boosted.get(user["uid"], 0)
+        )
+        age = time.time() - last_activity
+        if age < POLL_HOT_WINDOW: return "hot"
+        if age < POLL_WARM_WINDOW: return "warm"
+        return "idle"
+
+    def schedule(self, uid: str, delay: float):
+        due = time.monotonic() + delay
+        self.due_at[uid] = due
+        heapq.heappush(self.heap, (due, uid))
+
+    def _forget(self, uid: str):
+        self.due_at.pop(uid, None)
+        self.tiers.pop(uid, None)
+        self.boosted.pop(uid, None)
+        self.fired.pop(uid, None)
+        self.pushed.pop(uid, None)
+        self.push_due.discard(uid)
+
+    def new_push(self, uid: str, u: dict) -> bool:
+        """True once per fresh 'push_at' on the doc: mail arrived, poll now."""
+        at = u.get("push_at") or 0
+        if at <= self.pushed.get(uid, 0): return False
+        self.pushed[uid] = at
+        # Old hints (seen first at startup / takeover) are covered by the first poll
+        return time.time() - at < TIER_INTERVALS["push"]
+
+    def _track(self, uid: str, u: dict, known: bool):
+        if self.new_push(uid, u): self.push_due.add(uid)
+        if known:
+            # Became hot elsewhere (e.g. Gen New handled by another instance)
+            if self.tiers.get(uid) != "hot" and self.tier(u) == "hot":
+                self.tiers[uid] = "hot"
+                self.schedule(uid, 0)
+            return
+        if uid not in self.due_at:
+            tier = self.tier(u)
+            self.tiers[uid] = tier
+            # Spread start times so a restart doesn't poll everyone at once
+            delay = 0 if tier == "hot" else random.uniform(0, TIER_INTERVALS[tier])
+            self.schedule(uid, delay)
+
+    def sync(self, user_list: list):
+        """Adds new active users (with a random start offset) and forgets gone ones."""
+        fresh = {u["uid"]: u for u in user_list}
+
+        for uid in self.users.keys() - fresh.keys():
+            self._forget(uid)
+        for uid, u in fresh.items():
+            self._track(uid, u, uid in self.users)
+
+        self.users = fresh
+
+    def update(self, uid: str, user: dict = None):
+        """sync() for a single changed user (None: logged out / not ours any more)."""
+        if user is None:
+            if self.users.pop(uid, None) is not None:
+                self._forget(uid)
+            return
+        self._track(uid, user, uid in self.users)
+        self.users[uid] = user
+
+    def take_pushes(self) -> set:
+        """uids whose doc got a fresh push hint since the last call."""
+        due, self.push_due = self.push_due, set()
+        return due
+
+    def mark_hot(self, uid: str):
+        """User is actively waiting for a mail: poll now and keep polling fast."""
+        self.boosted[uid] = time.time()
+        if uid in self.users:
+            self.tiers[uid] = "hot"
+            self.schedule(uid, 0)
+
+    def pop_due(self) -> list:
+        """Returns the user docs whose poll is due right now."""
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            at, uid = heapq.heappop(self.heap)
+            # Skip superseded entries and users that went inactive
+            if self.due_at.get(uid) != at or uid not in self.users: continue
+            del self.due_at[uid]
+            POLL_LAG.observe(now - at)
+            self.fired[uid] = time.time() - (now - at)
+            due.append(self.users[uid])
+        return due
+
+    def take_due(self, uid: str):
+        """Wall-clock time the poll now starting was due (None if unknown)."""
+        return self.fired.pop(uid, None)
+
+    def reschedule(self, uid: str):
+        """Puts a user back in the queue after a poll, based on its current tier."""
+        user = self.users.get(uid)
+        if not user or uid in self.due_at: return
+        tier = self.tier(user)
+        self.tiers[uid] = tier
+        interval = TIER_INTERVALS[tier]
+        self.schedule(uid, interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER))
+
+    def sleep_for(self, max_sleep: float) -> float:
+        """Seconds until the next user is due (capped)."""
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return max_sleep
+        return min(max_sleep, max(0.0, self.heap[0][0] - time.monotonic()))
+
+    def stats(self) -> dict:
+        counts = {tier: 0 for tier in TIER_INTERVALS}
+        for tier in self.tiers.values():
+            counts[tier] += 1
+        return {
+            "users": len(self.users),
+            "tiers": counts,
+            "intervals": dict(TIER_INTERVALS),
+            "hot_window": POLL_HOT_WINDOW,
+            "warm_window": POLL_WARM_WINDOW,
+            "jitter": POLL_JITTER,
+        }
+
+SCHEDULER = PollScheduler()
+
+def mark_hot(uid: str):
+    SCHEDULER.mark_hot(uid)
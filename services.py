@@ -1,74 +1,218 @@
 import time
-import re
 import asyncio
 import datetime
+import logging
 import aiohttp
-from base64 import urlsafe_b64decode
-from email import message_from_bytes
-from config import CLIENT_ID, CLIENT_SECRET
-from database import users, seen_msgs, update_user, get_user, USER_CACHE
+from html import unescape
+from database import update_user, get_user, buffer_update, SEEN_INDEX
+from scheduler import SCHEDULER
+from push import submit_push
+from registry import REGISTRY
+from partitions import LEASES
+from executor import EXECUTOR
+from http_client import get_session
+from tokens import TOKENS
+from batch import BATCHER
+from extractor import extract_otp
+from offload import OFFLOAD
+from outbox import OUTBOX
+from config import BATCH_ENABLED, METADATA_FIRST, GMAIL_API_ROOT
+from metrics import count_error, observe_gmail, OTPS, WATCHER_CYCLE
+from tracing import OtpTrace
+
+logger = logging.getLogger(__name__)
 
 # --- CONSTANTS ---
 TIMEOUT = aiohttp.ClientTimeout(total=5)
 BD_TZ = datetime.timezone(datetime.timedelta(hours=6))
+GMAIL_API = f"{GMAIL_API_ROOT}/gmail/v1/users/me"
+
+# History pages to follow per poll before waiting for the next one
+HISTORY_MAX_PAGES = 3
+
+# Cheap first-tier fetch: just the headers we read, plus the snippet
+METADATA_PARAMS = "format=metadata&metadataHeaders=Subject&metadataHeaders=From"
+# How many bodies were answered by the metadata tier vs. a full raw download
+FETCH_STATS = {"metadata": 0, "raw": 0}
+
+# Metric label per Gmail endpoint (last URL segment)
+GMAIL_CALL_NAMES = {"messages": "list", "history": "history", "profile": "profile"}
 
 # Tracks active sessions so we trigger the "Fresh Start" only once per login
 ACTIVE_SESSION_CACHE = {}
 
 async def refresh_google_token(uid, session, refresh_token):
-    """Refreshes the Google Access Token if expired."""
-    if not refresh_token: return None
-    
-    data = {
-        "client_id": CLIENT_ID, 
-        "client_secret": CLIENT_SECRET, 
-        "refresh_token": refresh_token, 
-        "grant_type": "refresh_token"
-    }
-    
+    """Refreshes the Google Access Token (single-flight, see tokens.py)."""
+    return await TOKENS.refresh(uid, session, refresh_token)
+
+async def fetch_message(access, mid, session, params):
+    """One messages.get (through the batch endpoint when enabled). Returns (status, json)."""
+    path = f"/gmail/v1/users/me/messages/{mid}?{params}"
+    started = time.monotonic()
+    status, res = None, None
     try:
-        async with session.post("https://oauth2.googleapis.com/token", data=data, timeout=TIMEOUT) as r:
-            res = await r.json()
-            if "access_token" in res:
-                await update_user(uid, {"access": res["access_token"]})
-                return res["access_token"]
-    except: pass
-    return None
-
-async def fetch_body_task(access, mid, session):
+        if BATCH_ENABLED:
+            status, res = await BATCHER.get(access, path)
+        else:
+            headers = {"Authorization": f"Bearer {access}"}
+            async with session.get(f"{GMAIL_API}/messages/{mid}?{params}", headers=headers, timeout=TIMEOUT) as r:
+                status, res = r.status, await r.json()
+    except Exception as e: count_error("gmail_get", e)
+    observe_gmail("get", status, started)
+    return status, res
+
+async def fetch_body_task(access, mid, session, trace=None):
+    """
+    Fetches a message and finds its OTP, cheapest source first:
+    1. format=metadata (Subject + snippet, a few hundred bytes). Used when
+       the extractor is confident about the code in it.
+    2. format=raw (full RFC822 message) only when that is ambiguous.
+    Returns (sender, OtpMatch or None), or None if the fetch failed and
+    should be retried (a deleted or unreadable message counts as done).
+    'trace' (an OtpTrace) gets the arrival time and fetch/extract stages.
     """
-    Fetches a single email body.
-    Includes logic to read HTML if Plain Text is missing.
+    if METADATA_FIRST:
+        status, res = await fetch_message(access, mid, session, METADATA_PARAMS)
+        if status == 200 and res:
+            if trace:
+                trace.set_arrival(res)
+                trace.mark("fetched")
+            headers = {h["name"].lower(): h["value"] for h in res.get("payload", {}).get("headers", [])}
+            sender = headers.get("from", "")
+            text = f"{headers.get('subject', '')}\n{unescape(res.get('snippet', ''))}"
+            match = extract_otp(text, sender)
+            if match and match.confident:
+                FETCH_STATS["metadata"] += 1
+                if trace: trace.mark("extracted")
+                return sender, match
+
+    FETCH_STATS["raw"] += 1
+    status, res = await fetch_message(access, mid, session, "format=raw")
+    # Deleted since it was listed: retrying can't help
+    if status == 404: return "", None
+    if status != 200 or not res: return None
+    raw = res.get("raw")
+    if not raw: return "", None
+    if trace:
+        trace.set_arrival(res)
+        trace.mark("fetched")
+
+    # Bounded single-walk parse + extraction, off the event loop for
+    # big payloads when enabled (see mime.py, offload.py)
+    try: result = await OFFLOAD.scan(raw)
+    except Exception as e:
+        count_error("mime_parse", e)
+        return "", None
+    if trace: trace.mark("extracted")
+    return result
+
+async def gmail_get(uid, session, url, params, access, refresh_token):
     """
+    GET against the Gmail API with one automatic token refresh on 401.
+    Returns (status, json, access). Status is None on network errors.
+    """
+    call = GMAIL_CALL_NAMES.get(url.rsplit("/", 1)[-1], "other")
     headers = {"Authorization": f"Bearer {access}"}
+    started = time.monotonic()
+    status = None
     try:
-        async with session.get(f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{mid}?format=raw", headers=headers, timeout=TIMEOUT) as r:
-            if r.status != 200: return None
-            res = await r.json()
-            raw = res.get("raw")
-            if not raw: return None
-            
-            try:
-                msg = message_from_bytes(urlsafe_b64decode(raw))
-                
-                # Logic: Prefer Plain Text -> Fallback to HTML
-                if msg.is_multipart():
-                    # 1. Try to find Plain Text
-                    for part in msg.walk():
-                        if part.get_content_type() == "text/plain": 
-                            return part.get_payload(decode=True).decode(errors="ignore")
-                    
-                    # 2. If no Plain Text, use HTML
-                    for part in msg.walk():
-                        if part.get_content_type() == "text/html": 
-                            return part.get_payload(decode=True).decode(errors="ignore")
-                else:
-                    # Not multipart, just get payload
-                    return msg.get_payload(decode=True).decode(errors="ignore")
-                    
-                return None
-            except: return None
-    except: return None
+        async with session.get(url, params=params, headers=headers, timeout=TIMEOUT) as r:
+            status = r.status
+            if r.status != 401:
+                res = await r.json()
+                observe_gmail(call, status, started)
+                return r.status, res, access
+        observe_gmail(call, status, started)
+
+        access = await refresh_google_token(uid, session, refresh_token)
+        if not access: return 401, None, None
+        headers["Authorization"] = f"Bearer {access}"
+        started, status = time.monotonic(), None
+        async with session.get(url, params=params, headers=headers, timeout=TIMEOUT) as r2:
+            status = r2.status
+            res = await r2.json()
+            observe_gmail(call, status, started)
+            return r2.status, res, access
+    except Exception as e:
+        count_error(f"gmail_{call}", e)
+        observe_gmail(call, None, started)
+    return None, None, access
+
+async def full_resync(uid, user, session, access, refresh_token):
+    """
+    Slow path: plain search for the latest unread mail, plus a fresh
+    History checkpoint so the next polls can run incrementally.
+    The checkpoint is read first: mail arriving in between shows up in
+    the next History call instead of falling through the gap.
+    """
+    checkpoint = None
+    status, profile, access = await gmail_get(uid, session, f"{GMAIL_API}/profile", None, access, refresh_token)
+    if not access: return [], None, None
+    if status == 200 and profile.get("historyId"):
+        checkpoint = profile["historyId"]
+
+    new_ids = []
+    params = {"q": "is:unread newer_than:1d", "maxResults": 1}
+    status, res, access = await gmail_get(uid, session, f"{GMAIL_API}/messages", params, access, refresh_token)
+    if not access: return [], None, None
+    if status != 200: return [], access, None
+    new_ids = [m['id'] for m in res.get("messages", [])]
+
+    return new_ids, access, checkpoint
+
+async def fetch_new_ids(uid, user, session, access, refresh_token):
+    """
+    Incremental sync: asks the History API only for 'messagesAdded' since the
+    stored checkpoint. Falls back to a full resync when there is no checkpoint
+    yet or Google reports it as expired (404).
+    Returns (new_ids, access, checkpoint). access is None if the token is
+    dead. The checkpoint is NOT stored here: the caller saves it once every
+    listed id was fetched (see save_checkpoint), so a failed fetch is
+    listed again by the next poll.
+    """
+    history_id = user.get("history_id")
+    if not history_id:
+        return await full_resync(uid, user, session, access, refresh_token)
+
+    new_ids = []
+    checkpoint = history_id
+    params = {"startHistoryId": history_id, "historyTypes": "messageAdded"}
+
+    for _ in range(HISTORY_MAX_PAGES):
+        status, res, access = await gmail_get(uid, session, f"{GMAIL_API}/history", params, access, refresh_token)
+        if not access: return [], None, None
+
+        # Checkpoint too old (or invalid) -> start over
+        if status == 404:
+            user["history_id"] = None
+            return await full_resync(uid, user, session, access, refresh_token)
+        if status != 200: return [], access, None
+
+        for record in res.get("history", []):
+            for added in record.get("messagesAdded", []):
+                m = added.get("message", {})
+                labels = m.get("labelIds", [])
+                # Same filter as the old 'is:unread' search (skips Sent, Drafts, Spam)
+                if "UNREAD" not in labels or "SPAM" in labels or "TRASH" in labels: continue
+                if m["id"] not in new_ids:
+                    new_ids.append(m["id"])
+
+        if not res.get("nextPageToken"):
+            checkpoint = res.get("historyId", checkpoint)
+            break
+        # More pages than we follow per poll: the next poll resumes after
+        # the last record handled here, not at the newest historyId
+        records = res.get("history") or []
+        if records: checkpoint = records[-1].get("id", checkpoint)
+        params["pageToken"] = res["nextPageToken"]
+
+    return new_ids, access, (checkpoint if checkpoint != history_id else None)
+
+def save_checkpoint(uid, user, checkpoint):
+    """Moves the History checkpoint forward (once everything before it was handled)."""
+    if not checkpoint: return
+    user["history_id"] = checkpoint
+    buffer_update(uid, {"history_id": checkpoint})
 
 async def send_fresh_dashboard(bot, uid, user_data):
     """
@@ -82,18 +226,19 @@ async def send_fresh_dashboard(bot, uid, user_data):
     old_msg_id = user_data.get("main_msg_id")
     if old_msg_id:
         try:
-            await bot.delete_message(chat_id=uid, message_id=old_msg_id)
+            await OUTBOX.delete(bot, uid, old_msg_id)
         except:
-            pass # If message is too old or missing, ignore error
+            pass # If message is too old or missing, ignore error (counted by the outbox)
 
     # 2. SEND NEW MESSAGE
     try:
-        sent_msg = await bot.send_message(chat_id=uid, text=text, reply_markup=kb, parse_mode="HTML")
+        sent_msg = await OUTBOX.send(bot, uid, text=text, reply_markup=kb, parse_mode="HTML")
         
         # 3. Save the NEW ID so future OTP updates edit THIS message
         await update_user(uid, {"main_msg_id": sent_msg.message_id})
     except Exception as e:
-        print(f"Failed to send dashboard: {e}")
+        count_error("send_dashboard", e)
+        logger.error(f"Failed to send dashboard: {e}")
 
 async def update_live_ui(bot, uid, fresh_user=None):
     """Standard UI update for OTPs (Edits existing message)."""
@@ -109,17 +254,25 @@ async def update_live_ui(bot, uid, fresh_user=None):
     if not msg_id: return
     
     try: 
-        await bot.edit_message_text(
-            chat_id=uid, 
-            message_id=msg_id, 
+        # Rate-limited, and coalesced with other pending edits of this message
+        await OUTBOX.edit(
+            bot,
+            uid, 
+            msg_id, 
             text=text, 
             reply_markup=kb, 
             parse_mode="HTML"
         )
-    except: pass
+        return True
+    except Exception as e: count_error("update_live_ui", e)
+    return False
 
-async def process_user(bot, uid, session, manual=False, user_data=None):
-    """Main Logic: Checks user status and emails."""
+async def process_user(bot, uid, session, manual=False, user_data=None, scheduled_at=None):
+    """
+    Main Logic: Checks user status and emails.
+    scheduled_at: when the watcher's poll was due (for time-to-OTP traces).
+    """
+    scheduled_at = scheduled_at or time.time()
     # Use passed user_data if available (FRESH), otherwise fetch from DB
     if user_data:
         user = user_data
@@ -129,8 +282,9 @@ async def process_user(bot, uid, session, manual=False, user_data=None):
     if not user: return
     if not manual and not user.get("is_active", True): return
 
-    access = user.get("access")
     refresh_token = user.get("refresh")
+    # Refreshes ahead of expiry, so polls rarely hit a 401
+    access = await TOKENS.ensure_fresh(uid, user, session)
     
     # --- LOGOUT HANDLER ---
     if not access: 
@@ -147,95 +301,131 @@ async def process_user(bot, uid, session, manual=False, user_data=None):
         ACTIVE_SESSION_CACHE[uid] = True
 
     # --- EMAIL CHECKING ---
-    headers = {"Authorization": f"Bearer {access}"}
-    new_ids = []
-    
-    try:
-        params = {"q": "is:unread newer_than:1d", "maxResults": 1}
-        
-        async with session.get("https://gmail.googleapis.com/gmail/v1/users/me/messages", params=params, headers=headers, timeout=TIMEOUT) as r:
-                if r.status == 401:
-                    access = await refresh_google_token(uid, session, refresh_token)
-                    if not access: return
-                    headers["Authorization"] = f"Bearer {access}"
-                    async with session.get("https://gmail.googleapis.com/gmail/v1/users/me/messages", params=params, headers=headers, timeout=TIMEOUT) as r2: 
-                        res = await r2.json()
-                else: 
-                    res = await r.json()
-                
-                if "messages" in res:
-                    new_ids = [m['id'] for m in res["messages"]]
-
-    except: pass
+    new_ids, access, checkpoint = await fetch_new_ids(uid, user, session, access, refresh_token)
+    if not access: return
+    listed_at = time.time()
 
     if not new_ids:
+        save_checkpoint(uid, user, checkpoint)
         if manual: 
-            await update_user(uid, {"last_check": datetime.datetime.now(BD_TZ).strftime("%I:%M:%S %p")})
+            buffer_update(uid, {"last_check": datetime.datetime.now(BD_TZ).strftime("%I:%M:%S %p")})
         return
 
-    # Filter out messages we have already processed
-    to_fetch = [mid for mid in new_ids if not await seen_msgs.find_one({"key": f"{uid}:{mid}"})]
-    if not to_fetch: return
+    # Filter out messages we have already processed (RAM, then one batched DB query)
+    to_fetch = await SEEN_INDEX.filter_unseen(uid, new_ids)
+    if not to_fetch:
+        save_checkpoint(uid, user, checkpoint)
+        return
 
     # --- Fetch all new bodies in parallel ---
-    tasks = [fetch_body_task(access, mid, session) for mid in to_fetch]
+    traces = [OtpTrace(uid, mid, scheduled_at, listed_at) for mid in to_fetch]
+    tasks = [fetch_body_task(access, mid, session, trace) for mid, trace in zip(to_fetch, traces)]
     bodies = await asyncio.gather(*tasks)
     
     new_otp = False
-    for mid, body in zip(to_fetch, bodies):
-        if not body: continue
-        
-        # Regex to find OTPs (4-8 digits)
-        codes = re.findall(r"\b\d{4,8}\b", body)
-        if codes:
-            otp_code = codes[0]
+    seen_now = []
+    delivered = []
+    failed = False
+    for mid, fetched, trace in zip(to_fetch, bodies, traces):
+        if not fetched:
+            failed = True
+            continue
+        seen_now.append(mid)
+        # Sender templates + keyword-scored candidates (see extractor.py);
+        # extract_otp never reports a number scoring below MIN_SCORE
+        sender, match = fetched
+        if match:
+            otp_code = match.code
             formatted = (
                 f"✨ <b>New OTP Received</b>\n"
-                f"⏰ {datetime.datetime.now(BD_TZ).strftime('%I:%M:%S %p')}"
+                + (f"📱 {match.app}\n" if match.app else "")
+                + f"⏰ {datetime.datetime.now(BD_TZ).strftime('%I:%M:%S %p')}"
             )
             
-            # 1. Update Database
-            await update_user(uid, {
+            otp_data = {
                 "latest_otp": formatted, 
                 "last_otp_raw": otp_code,
                 "last_otp_timestamp": time.time()
-            })
-            await users.update_one({"uid": uid}, {"$inc": {"captured": 1}})
+            }
+
+            # 1. Update Database (batched with the counter, see WriteBehind)
+            buffer_update(uid, otp_data, {"captured": 1})
+            OTPS.inc()
+            trace.app = match.app
+            trace.mark("stored")
+            delivered.append(trace)
 
             # 2. CRITICAL FIX: Update the LOCAL user object immediately
             # This ensures the 'user' variable passed to the UI below has the NEW OTP.
-            user["latest_otp"] = formatted
-            user["last_otp_raw"] = otp_code
-            user["last_otp_timestamp"] = time.time()
+            user.update(otp_data)
             
             new_otp = True
 
-        if not manual: 
-            await seen_msgs.update_one({"key": f"{uid}:{mid}"}, {"$set": {"at": time.time()}}, upsert=True)
+    # Persist all newly seen ids in one write
+    if not manual: 
+        await SEEN_INDEX.mark_seen(uid, seen_now)
+    # A failed fetch keeps the old checkpoint, so the next poll lists it
+    # again (the ones handled now are skipped as seen)
+    if not failed:
+        save_checkpoint(uid, user, checkpoint)
 
-    await update_user(uid, {"last_check": datetime.datetime.now(BD_TZ).strftime("%I:%M:%S %p")})
+    buffer_update(uid, {"last_check": datetime.datetime.now(BD_TZ).strftime("%I:%M:%S %p")})
     
     # If OTP comes, we edit the EXISTING message using the updated 'user' object
-    if new_otp: await update_live_ui(bot, uid, fresh_user=user)
+    if new_otp and await update_live_ui(bot, uid, fresh_user=user):
+        acked_at = time.time()
+        for trace in delivered:
+            trace.mark("delivered", acked_at)
+            trace.finish()
 
 async def background_watcher(bot):
     """
-    Background Worker. Runs every 0.5 seconds.
+    Background Worker. Polls each active user on its own cadence
+    (see scheduler.py): hot users every 0.5s, idle ones much less often.
+    Polls run on a bounded worker pool (see executor.py), so one slow
+    mailbox never delays anybody else.
+    With several instances running, each one only polls the users in the
+    partitions it holds a lease on (see partitions.py).
     """
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                # 1. Fetch FRESH data from MongoDB (Bypassing Cache to detect logins)
-                cursor = users.find({"is_active": True})
-                user_list = await cursor.to_list(None)
-                
-                # 2. Update RAM Cache (for the rest of the bot to be fast)
-                for u in user_list:
-                    USER_CACHE[u["uid"]] = u
-                
-                if user_list: 
-                    # 3. Pass this FRESH data directly to process_user
-                    await asyncio.gather(*(process_user(bot, u["uid"], session, user_data=u) for u in user_list), return_exceptions=True)
-            except: pass
-            
-            await asyncio.sleep(0.5)
+    # Active users come from the in-memory registry (kept live by change
+    # streams). MongoDB may still be down at boot: retry instead of dying
+    retry = 1
+    while True:
+        try:
+            await REGISTRY.start()
+            break
+        except Exception as e:
+            count_error("registry_start", e)
+            logger.error(f"Registry load failed, retrying in {retry}s: {e}")
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, 30)
+    synced_leases = None
+
+    EXECUTOR.start(
+        run=lambda u: process_user(bot, u["uid"], get_session(), user_data=u, scheduled_at=SCHEDULER.take_due(u["uid"])),
+        on_done=SCHEDULER.reschedule
+    )
+    while True:
+        started = time.monotonic()
+        try:
+            # 1. Pick up logins / logouts since the last tick: just the
+            # users that changed, everyone only when partitions moved
+            # between instances or the registry reloaded
+            reloaded, changed = REGISTRY.take_changes()
+            if reloaded or LEASES.version != synced_leases:
+                synced_leases = LEASES.version
+                SCHEDULER.sync(LEASES.mine(REGISTRY.snapshot()))
+            else:
+                for uid in changed:
+                    SCHEDULER.update(uid, REGISTRY.users.get(uid) if LEASES.owns(uid) else None)
+            # Pushes another instance received for our users (see handle_gmail_push)
+            for uid in SCHEDULER.take_pushes():
+                submit_push(uid)
+
+            # 2. Hand every due user to the executor (doesn't wait for them)
+            for u in SCHEDULER.pop_due():
+                EXECUTOR.submit(u)
+        except Exception as e: count_error("watcher", e)
+        WATCHER_CYCLE.observe(time.monotonic() - started)
+        
+        await asyncio.sleep(SCHEDULER.sleep_for(max_sleep=0.5))
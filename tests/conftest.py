@@ -0,0 +1,13 @@
+import os
+import sys
+
+# config.py exits without these; the suite never talks to Telegram or Mongo
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Before any test module imports the collections (see database.set_client)
+import database
+from fakes import MemoryMongoClient
+database.set_client(MemoryMongoClient())
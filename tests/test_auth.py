@@ -0,0 +1,21 @@
+import asyncio
+from urllib.parse import urlparse, parse_qs
+
+import auth
+from database import oauth_states
+
+def state_of(url: str) -> str:
+    return parse_qs(urlparse(url).query)["state"][0]
+
+def test_login_state_is_reused_until_used():
+    async def run():
+        first = state_of(await auth.get_login_url("7001"))
+        assert state_of(await auth.get_login_url("7001")) == first
+        assert state_of(await auth.get_login_url("7002")) != first
+
+        # The callback (on any instance) deletes the state it consumed
+        await oauth_states.delete_one({"state": first})
+        fresh = state_of(await auth.get_login_url("7001"))
+        assert fresh != first
+        assert await oauth_states.find_one({"state": fresh})
+    asyncio.run(run())
@@ -0,0 +1,33 @@
+import pytest
+
+from extractor import extract_otp
+
+@pytest.mark.parametrize("text, code", [
+    ("Code:482913", "482913"),
+    ("Your OTP:1234", "1234"),
+    ("OTP=482913", "482913"),
+    ("Your verification code is 482913.", "482913"),
+    ("482913 is your verification code", "482913"),
+    ("Your code: 123-456", "123456"),
+])
+def test_finds_code(text, code):
+    match = extract_otp(text)
+    assert match and match.code == code and match.confident
+
+@pytest.mark.parametrize("text", [
+    "Order 123456 has shipped",
+    "Meeting moved to 12:3045",
+    "Total: $1234.50",
+    "Happy 2024!",
+    "See attachment 482913",
+])
+def test_ignores_non_codes(text):
+    assert extract_otp(text) is None
+
+def test_sender_template_wins():
+    match = extract_otp("G-482913 is your Google verification code. Ref 999999", "no-reply@accounts.google.com")
+    assert match.code == "482913" and match.app == "Google" and match.confident
+
+def test_keyword_beats_reference_number():
+    match = extract_otp("Ref 77881234. Your login code is 482913")
+    assert match.code == "482913"
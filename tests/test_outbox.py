@@ -0,0 +1,73 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from fakes import FakeBotApi
+from outbox import Outbox
+
+async def _with_bot(test):
+    api = FakeBotApi()
+    app = web.Application()
+    api.register(app)
+    server = TestServer(app)
+    await server.start_server()
+    base = str(server.make_url("")).rstrip("/")
+    bot = Bot(token="123456:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    try:
+        await test(api, bot)
+    finally:
+        await bot.session.close()
+        await server.close()
+
+def test_delete_reaches_bot_api():
+    async def test(api, bot):
+        outbox = Outbox()
+        assert await outbox.delete(bot, 42, 1001) is True
+        assert api.deletes == [("42", 1001)]
+        assert outbox.sent == 1 and outbox.failed == 0
+    asyncio.run(_with_bot(test))
+
+def test_delete_forgets_rendered_message():
+    async def test(api, bot):
+        outbox = Outbox()
+        sent = await outbox.send(bot, 42, text="hi")
+        assert ("42", sent.message_id) in outbox.rendered
+        await outbox.delete(bot, 42, sent.message_id)
+        assert ("42", sent.message_id) not in outbox.rendered
+        assert api.calls == {"sendMessage": 1, "deleteMessage": 1}
+    asyncio.run(_with_bot(test))
+
+def test_retry_after_from_several_chats_pauses_every_chat():
+    async def run():
+        outbox = Outbox()
+        attempts = {}
+        async def flaky(chat_id):
+            attempts[chat_id] = attempts.get(chat_id, 0) + 1
+            if attempts[chat_id] == 1:
+                raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=""), "Flood control exceeded", 0.2)
+            return True
+
+        await asyncio.gather(*(outbox.call(chat, flaky, chat_id=chat) for chat in (1, 2, 3)))
+        assert outbox.global_pauses >= 1 and outbox.retried == 3
+        assert outbox.bucket.blocked_until > 0
+    asyncio.run(run())
+
+def test_single_chat_retry_after_leaves_other_chats_alone():
+    async def run():
+        outbox = Outbox()
+        attempts = []
+        async def flaky(chat_id):
+            attempts.append(chat_id)
+            if len(attempts) == 1:
+                raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=""), "Flood control exceeded", 0.2)
+            return True
+
+        await outbox.call(1, flaky, chat_id=1)
+        assert outbox.global_pauses == 0 and outbox.bucket.blocked_until == 0
+    asyncio.run(run())
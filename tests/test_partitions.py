@@ -0,0 +1,24 @@
+import asyncio
+
+from partitions import PartitionLeases
+
+def worker(_id, deployment, deployed_at, started_at):
+    return {"_id": _id, "ready": True, "deployment": deployment, "deployed_at": deployed_at, "started_at": started_at}
+
+def test_restarted_old_replica_does_not_supersede_new_deployment():
+    live = [
+        worker("old-1", "v1", 100, 100),
+        worker("new-1", "v2", 500, 500),
+        worker("new-2", "v2", 500, 510),
+        # v1 replica that crashed and came back after v2 was up
+        worker("old-2", "v1", 100, 900),
+    ]
+    assert PartitionLeases.members_of(live) == ["new-1", "new-2"]
+
+def test_replicas_share_the_first_start_of_their_deployment():
+    async def run():
+        first, later = PartitionLeases("a"), PartitionLeases("b")
+        later.started_at = first.started_at + 60
+        assert await first.deployment_started() == first.started_at
+        assert await later.deployment_started() == first.started_at
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+import json
+from base64 import b64encode
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import push
+from database import users
+from partitions import LEASES, partition_of
+from scheduler import SCHEDULER
+
+def envelope(email: str, history_id: int) -> dict:
+    data = json.dumps({"emailAddress": email, "historyId": history_id}).encode()
+    return {"message": {"data": b64encode(data).decode()}}
+
+def test_push_for_another_instance_is_handed_over(monkeypatch):
+    monkeypatch.setattr(push, "PUSH_TOPIC", "projects/p/topics/gmail")
+    monkeypatch.setattr(push, "PUSH_TOKEN", "secret")
+    monkeypatch.setattr(LEASES, "owned", set())
+
+    async def run():
+        await users.insert_one({"uid": "42", "email": "a@example.com", "is_active": True})
+        app = web.Application()
+        app.router.add_post("/gmail/push", push.handle_gmail_push)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post("/gmail/push?token=secret", json=envelope("a@example.com", 5))
+            assert resp.status == 204
+
+        # Not ours: the push is left on the doc instead of being dropped
+        doc = await users.find_one({"uid": "42"})
+        assert doc.get("push_at")
+
+        # The owner's registry applies the changed doc -> one push run
+        LEASES.owned = {partition_of("42")}
+        SCHEDULER.update("42", doc)
+        assert SCHEDULER.take_pushes() == {"42"}
+        SCHEDULER.update("42", dict(doc))
+        assert SCHEDULER.take_pushes() == set()
+        SCHEDULER.update("42", None)
+    asyncio.run(run())
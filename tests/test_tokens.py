@@ -0,0 +1,79 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import handlers
+import tokens
+from database import get_user
+from fakes import FakeBotApi
+from http_client import start_http, close_http
+
+TOKEN_DELAY = 0.3
+
+async def slow_token_endpoint(request):
+    await asyncio.sleep(TOKEN_DELAY)
+    return web.json_response({"access_token": "a", "refresh_token": "r", "expires_in": 3600})
+
+async def userinfo_endpoint(request):
+    return web.json_response({"email": "paste@example.com", "name": "Paste"})
+
+def pasted_code(uid: int) -> Update:
+    return Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 10,
+            "date": 0,
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": "T"},
+            "text": "http://localhost/?code=4/0AbCdEf_123&scope=email",
+        },
+    })
+
+def test_manual_code_paste_does_not_block_the_loop(monkeypatch):
+    async def no_refresh(bot, uid): pass
+
+    async def run():
+        api = FakeBotApi()
+        app = web.Application()
+        api.register(app)
+        app.router.add_post("/token", slow_token_endpoint)
+        app.router.add_get("/userinfo", userinfo_endpoint)
+        server = TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(tokens, "TOKEN_URL", str(server.make_url("/token")))
+        monkeypatch.setattr(handlers, "USERINFO_URL", str(server.make_url("/userinfo")))
+        # The first mailbox poll is not what this test is about
+        monkeypatch.setattr(handlers, "refresh_and_repost", no_refresh)
+
+        base = str(server.make_url("")).rstrip("/")
+        bot = Bot(token="123456:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+        dp = Dispatcher()
+        dp.include_router(handlers.router)
+        await start_http()
+
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        try:
+            await dp.feed_update(bot, pasted_code(9001))
+        finally:
+            task.cancel()
+            await close_http()
+            await bot.session.close()
+            await server.close()
+
+        user = await get_user("9001")
+        assert user["email"] == "paste@example.com" and user["access"] == "a"
+        # The ticker kept running while the handler waited on the token endpoint
+        assert ticks >= TOKEN_DELAY / 0.01 * 0.5
+    asyncio.run(run())
@@ -0,0 +1,133 @@
+import time
+import zlib
+import asyncio
+import logging
+import aiohttp
+from config import CLIENT_ID, CLIENT_SECRET, TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_JITTER
+from database import update_user
+from metrics import count_error, TOKEN_CALLS, TOKEN_LATENCY
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+USERINFO_URL = "https://www.googleapis.com/oauth2/v1/userinfo?alt=json"
+TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+def expiry_from(token_response: dict) -> float:
+    """Absolute expiry time for a fresh token response (Google sends 'expires_in' seconds)."""
+    return time.time() + int(token_response.get("expires_in", 3600))
+
+async def exchange_code(session, code: str, redirect_uri: str) -> dict:
+    """
+    Authorization code -> token response (async, on the shared HTTP client).
+    Returns Google's JSON; on failure it contains an 'error' key.
+    """
+    data = {
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "code": code,
+        "grant_type": "authorization_code",
+        "redirect_uri": redirect_uri,
+    }
+    started = time.monotonic()
+    try:
+        async with session.post(TOKEN_URL, data=data, timeout=TIMEOUT) as resp:
+            res = await resp.json()
+    except Exception:
+        TOKEN_CALLS.inc(kind="exchange", result="error")
+        raise
+    finally:
+        TOKEN_LATENCY.observe(time.monotonic() - started, kind="exchange")
+    TOKEN_CALLS.inc(kind="exchange", result="error" if "error" in res else "ok")
+    return res
+
+class TokenManager:
+    """
+    Keeps Google access tokens fresh.
+    - Refreshes BEFORE expiry ('access_expires_at' on the user doc), with a
+      per-user offset so users don't all refresh in the same second.
+    - Concurrent refreshes for the same uid share one request (single-flight).
+    """
+    def __init__(self):
+        self.inflight = {}
+
+        # --- Stats ---
+        self.refreshes = 0
+        self.proactive = 0
+        self.failures = 0
+        self.coalesced = 0
+
+    def refresh_due(self, uid: str, user: dict) -> bool:
+        expires_at = user.get("access_expires_at")
+        if not expires_at: return False  # Unknown (old login) -> wait for a 401
+        # Stable per-user offset in [0, JITTER) spreads refreshes across users
+        jitter = (zlib.crc32(uid.encode()) % 1000) / 1000 * TOKEN_REFRESH_JITTER
+        return time.time() >= expires_at - TOKEN_REFRESH_MARGIN - jitter
+
+    async def ensure_fresh(self, uid: str, user: dict, session):
+        """Returns a usable access token, refreshing it first if it's about to expire."""
+        access = user.get("access")
+        if access and self.refresh_due(uid, user):
+            self.proactive += 1
+            fresh = await self.refresh(uid, session, user.get("refresh"))
+            if fresh:
+                user["access"] = fresh
+                return fresh
+        return access
+
+    async def refresh(self, uid: str, session, refresh_token):
+        """Single-flight refresh. Returns the new access token or None."""
+        if not refresh_token: return None
+
+        task = self.inflight.get(uid)
+        if task:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._request(uid, session, refresh_token))
+        self.inflight[uid] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                self.inflight.pop(uid, None)
+            else:
+                task.add_done_callback(lambda _: self.inflight.pop(uid, None))
+
+    async def _request(self, uid, session, refresh_token):
+        data = {
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token"
+        }
+        self.refreshes += 1
+        started = time.monotonic()
+        try:
+            async with session.post(TOKEN_URL, data=data, timeout=TIMEOUT) as r:
+                res = await r.json()
+            TOKEN_LATENCY.observe(time.monotonic() - started, kind="refresh")
+            if "access_token" in res:
+                TOKEN_CALLS.inc(kind="refresh", result="ok")
+                await update_user(uid, {
+                    "access": res["access_token"],
+                    "access_expires_at": expiry_from(res)
+                })
+                return res["access_token"]
+        except Exception as e:
+            count_error("token_refresh", e)
+            logger.debug(f"Token refresh failed for {uid}: {e}")
+        TOKEN_CALLS.inc(kind="refresh", result="error")
+        self.failures += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "refreshes": self.refreshes,
+            "proactive": self.proactive,
+            "failures": self.failures,
+            "coalesced": self.coalesced,
+            "inflight": len(self.inflight),
+        }
+
+TOKENS = TokenManager()
@@ -0,0 +1,82 @@
+import json
+import time
+import asyncio
+from collections import deque
+from config import OTP_TRACE_LOG
+from metrics import OTP_STAGES, count_error
+
+# In order; every stage is measured from Gmail's internalDate
+# - scheduled: the poll was due (push / manual: when it started)
+# - listed:    History / list call returned the message id
+# - fetched:   messages.get answered (the last tier used)
+# - extracted: code found in the text
+# - stored:    OTP in RAM + queued for MongoDB (write-behind flushes
+#              within WRITE_BEHIND_INTERVAL)
+# - delivered: Telegram acknowledged the dashboard edit
+STAGES = ("scheduled", "listed", "fetched", "extracted", "stored", "delivered")
+
+# Last finished traces (for debugging from a shell)
+RECENT = deque(maxlen=100)
+# Callables fed every finished record (benchmark.py collects from here)
+SINKS = []
+
+# JSON lines for OTP_TRACE_LOG, appended by one writer thread at a time
+# so a slow disk never stalls the event loop (oldest dropped past the cap)
+LOG_BUFFER = deque(maxlen=10000)
+_log_writer = None
+
+def _append_lines(lines: list):
+    with open(OTP_TRACE_LOG, "a") as f:
+        f.writelines(lines)
+
+async def _write_log():
+    global _log_writer
+    try:
+        while LOG_BUFFER:
+            lines = list(LOG_BUFFER)
+            LOG_BUFFER.clear()
+            try: await asyncio.to_thread(_append_lines, lines)
+            except OSError as e: count_error("otp_trace_log", e)
+    finally:
+        _log_writer = None
+
+def _log(record: dict):
+    global _log_writer
+    LOG_BUFFER.append(json.dumps(record) + "\n")
+    if _log_writer is None:
+        _log_writer = asyncio.get_running_loop().create_task(_write_log())
+
+class OtpTrace:
+    __slots__ = ("uid", "mid", "internal_ms", "app", "marks")
+
+    def __init__(self, uid: str, mid: str, scheduled: float, listed: float):
+        self.uid = uid
+        self.mid = mid
+        self.internal_ms = None
+        self.app = None
+        self.marks = {"scheduled": scheduled, "listed": listed}
+
+    def mark(self, stage: str, at: float = None):
+        self.marks[stage] = at if at is not None else time.time()
+
+    def set_arrival(self, res: dict):
+        """Takes internalDate (ms since epoch) from a messages.get response."""
+        try: self.internal_ms = int(res.get("internalDate"))
+        except (TypeError, ValueError): pass
+
+    def offsets(self) -> dict:
+        arrived = self.internal_ms / 1000
+        # A poll can be due before the mail arrived: that stage took no time
+        return {s: round(max(0.0, self.marks[s] - arrived), 3) for s in STAGES if s in self.marks}
+
+    def finish(self):
+        """Exports a delivered OTP: histograms, plus a JSON line if OTP_TRACE_LOG is set."""
+        if self.internal_ms is None: return
+        offsets = self.offsets()
+        for stage, seconds in offsets.items():
+            OTP_STAGES.observe(seconds, stage=stage)
+
+        record = {"uid": self.uid, "mid": self.mid, "app": self.app, "internal_date": self.internal_ms, "stages": offsets}
+        RECENT.append(record)
+        for sink in SINKS: sink(record)
+        if OTP_TRACE_LOG: _log(record)